@@ -0,0 +1,119 @@
+"""
+Check gzip compression of request and response bodies against a local
+stand-in for Grouper WS.
+
+The stand-in server decompresses gzipped request bodies, checks they are
+valid JSON, and gzips its replies when the client accepts it. Run with:
+
+    python benchmarks/compression_check.py
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import gzip
+import io
+import json
+import os
+import sys
+import threading
+
+from six.moves import BaseHTTPServer, socketserver
+
+# Use the grouper_ws package of this checkout
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from grouper_ws.api import Grouper
+
+
+GROUP_COUNT = 500
+
+RESPONSE = json.dumps({
+    'WsFindGroupsResults': {
+        'resultMetadata': {'success': 'T', 'resultCode': 'SUCCESS'},
+        'groupResults': [
+            {'name': 'test:group{0}'.format(i), 'displayExtension': 'Group {0}'.format(i)}
+            for i in range(GROUP_COUNT)
+        ],
+    },
+}).encode('utf-8')
+
+received = []
+
+
+def gzip_bytes(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def _reply(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        compressed = self.headers.get('Content-Encoding') == 'gzip'
+        if compressed:
+            body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+        json.loads(body.decode('utf-8'))
+        received.append(compressed)
+
+        content = RESPONSE
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/x-json')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            content = gzip_bytes(content)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_POST = do_PUT = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def check(transport, base_url):
+    grouper = Grouper(
+        'localhost', '/grouper-ws/', auth=('user', 'secret'), transport=transport,
+        compression=True, compress_threshold=1024
+    )
+    grouper.base_url = base_url
+    del received[:]
+
+    small = grouper.lookup_groups(['test:group0'])
+    large = grouper.lookup_groups(['test:group{0}'.format(i) for i in range(GROUP_COUNT)])
+    for response in (small, large):
+        assert len(response['WsFindGroupsResults']['groupResults']) == GROUP_COUNT
+    assert received == [False, True], "Expected only the large request to be gzipped"
+
+    stats = grouper.compression_stats.snapshot()
+    assert stats['request_bytes_sent'] < stats['request_bytes']
+    assert stats['response_bytes_received'] < stats['response_bytes']
+    print("{0:>8}: OK, {1} bytes saved over {2} requests".format(
+        transport, stats['bytes_saved'], stats['requests']
+    ))
+
+
+def main():
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base_url = 'http://127.0.0.1:{0}/grouper-ws/'.format(server.server_address[1])
+    try:
+        for transport in ('requests', 'urllib3'):
+            check(transport, base_url)
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
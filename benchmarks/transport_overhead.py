@@ -0,0 +1,97 @@
+"""
+Compare the per-call overhead of the requests and urllib3 transports.
+
+A local HTTP server answers every call with a small canned
+WsFindGroupsResults body, so the timings are dominated by client-side
+work rather than by Grouper. Run with:
+
+    python benchmarks/transport_overhead.py --calls 5000
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+from six.moves import BaseHTTPServer, socketserver
+
+# Use the grouper_ws package of this checkout
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from grouper_ws.api import Grouper
+
+
+RESPONSE = json.dumps({
+    'WsFindGroupsResults': {
+        'resultMetadata': {'success': 'T', 'resultCode': 'SUCCESS'},
+        'groupResults': [{'name': 'test:group', 'uuid': '0123456789abcdef'}],
+    },
+}).encode('utf-8')
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each reply in one write, avoiding Nagle/delayed-ACK stalls
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def _reply(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/x-json')
+        self.send_header('Content-Length', str(len(RESPONSE)))
+        self.end_headers()
+        self.wfile.write(RESPONSE)
+
+    do_POST = do_PUT = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def run(transport, base_url, calls):
+    grouper = Grouper('localhost', '/grouper-ws/', auth=('user', 'secret'), transport=transport)
+    grouper.base_url = base_url
+    grouper.lookup_groups(['test:group'])
+    started = time.time()
+    for _ in range(calls):
+        grouper.lookup_groups(['test:group'])
+    return (time.time() - started) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    base_url = 'http://127.0.0.1:{0}/grouper-ws/'.format(server.server_address[1])
+
+    best = {}
+    for _ in range(args.rounds):
+        for transport in ('requests', 'urllib3'):
+            per_call = run(transport, base_url, args.calls)
+            best[transport] = min(per_call, best.get(transport, per_call))
+    for transport in ('requests', 'urllib3'):
+        print("{0:>8}: {1:8.1f} us/call".format(transport, best[transport] * 1e6))
+    print("urllib3 saves {0:.1f} us/call ({1:.0%})".format(
+        (best['requests'] - best['urllib3']) * 1e6,
+        1 - best['urllib3'] / best['requests']
+    ))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,8 @@ import json
 import requests
 import logging
 import six
+import threading
+import time
 
 try: # Py3
     from urllib.parse import quote, urljoin
@@ -24,9 +26,23 @@ except ImportError:
             return None
         HTTPDefaultAuth = HTTPNegotiateAuthMock
 
+# Placeholder for the default authentication handler, which is only
+# constructed when the first request is made
+DEFAULT_AUTH = object()
+
 from .groups import *
 from .stems import *
 from .subjects import *
+from .cache import cache_key
+from .codec import DEFAULT_CODEC
+from .deadlines import Hedger, remaining, request_timeout
+from .compression import CompressionStats, gzip_bytes, wire_size, \
+    DEFAULT_COMPRESS_THRESHOLD
+from .metrics import request_endpoint, result_code
+from .singleflight import SingleFlight
+from .stem_queries import FindByStemName as FindStemByName
+from .transport import ClusterTransport, RequestsTransport, Urllib3Transport, \
+    host_failed, CONNECTION_ERRORS
 
 
 DEFAULT_SUBJECT_ATTRIBUTES = [
@@ -36,8 +52,33 @@ DEFAULT_SUBJECT_ATTRIBUTES = [
     "name"
 ]
 
+# Request types which do not modify Grouper, and so may safely be coalesced
+READ_REQUEST_TYPES = set([
+    'WsRestFindGroupsRequest',
+    'WsRestFindStemsRequest',
+    'WsRestGetMembersRequest',
+    'WsRestHasMemberRequest',
+    'WsRestGetSubjectsRequest',
+    'WsRestGetMembershipsRequest',
+    'WsRestGetGrouperPrivilegesLiteRequest',
+    'WsRestGetAttributeAssignmentsRequest',
+])
+
+JSON_HEADERS = {
+    'Content-type': 'text/x-json',
+}
+
+GZIP_JSON_HEADERS = {
+    'Content-type': 'text/x-json',
+    'Content-Encoding': 'gzip',
+}
+
+URL_CACHE_SIZE = 4096
+
 logger = logging.getLogger(__name__)
 
+_group_urls = {}
+
 def bool_to_tf_str(b):
     if b:
         return 'T'
@@ -62,6 +103,22 @@ def member_to_subject_lookup(member):
         return member.get_subject_lookup()
     raise Exception("member_to_subject_lookup(): Invalid member value")
 
+def is_read_request(data):
+    return len(data) == 1 and next(iter(data)) in READ_REQUEST_TYPES
+
+def group_url(group, endpoint):
+    """
+    Return the URL of a per-group endpoint, caching the quoted group name.
+    """
+    key = (group, endpoint)
+    url = _group_urls.get(key)
+    if url is None:
+        if len(_group_urls) >= URL_CACHE_SIZE:
+            _group_urls.clear()
+        url = 'servicesRest/v2_1_005/groups/{0}/{1}'.format(quote(group, safe=''), endpoint)
+        _group_urls[key] = url
+    return url
+
 def str_to_stem(stem):
     if isinstance(stem, Stem):
         return stem
@@ -76,34 +133,205 @@ def str_to_group(group):
 
 
 class Grouper(object):
-    def __init__(self, host_name, base_url, auth=HTTPDefaultAuth()):
+    def __init__(self, host_name, base_url, auth=DEFAULT_AUTH,
+                 coalesce_reads=False, limiter=None, codec=None,
+                 compression=False, compress_threshold=DEFAULT_COMPRESS_THRESHOLD,
+                 metrics=None, transport=None, balance_strategy='least_outstanding',
+                 timeout=None, hedge_percentile=None, cache=None, warm_up=False):
+        """
+        host_name may be a list of hosts, which requests are balanced across
+        by balance_strategy, retrying failed reads on another host (see
+        transport.ClusterTransport).
+
+        transport is 'requests' (the default), 'urllib3' for the leaner
+        transport.Urllib3Transport, or any transport object.
+
+        codec encodes and decodes bodies, by default with the fastest JSON
+        library installed (see codec.best_codec()). With compression, request
+        bodies of at least compress_threshold bytes are gzipped and sizes are
+        added to compression_stats. Responses are gzipped whenever the server
+        supports it, as both transports ask for it in every request.
+
+        limiter (see throttle.AdaptiveLimiter) and metrics (see
+        metrics.MetricsRegistry) are told about every HTTP call. cache (see
+        cache.SharedCache) serves repeated subject and group lookups.
+
+        Each HTTP call is bounded by timeout (seconds, or a (connect, read)
+        tuple) and by any deadlines.deadline() block it is made in. With
+        hedge_percentile, a read slower than that percentile of recent calls
+        to the same endpoint is sent again and the first answer is used.
+
+        With warm_up, a cheap lookup is made at once to open a connection.
+        """
+        hosts = None
+        if isinstance(host_name, (list, tuple)):
+            hosts = list(host_name)
+            host_name = hosts[0]
         self.host_name = host_name
         self.base_url = urljoin('https://' + self.host_name, base_url)
-        self.auth = auth
+        self._auth = auth
+        self._auth_lock = threading.Lock()
         self._session = requests.Session()
+        if transport is None or transport == 'requests':
+            transport = RequestsTransport(self._session)
+        elif transport == 'urllib3':
+            transport = Urllib3Transport(fallback=RequestsTransport(self._session))
+        self.transport = transport
+        if hosts is not None:
+            self.transport = ClusterTransport(hosts, self.transport, strategy=balance_strategy)
+        self.timeout = timeout
+        self._hedger = None
+        if hedge_percentile is not None:
+            self._hedger = Hedger(percentile=hedge_percentile)
+        self.limiter = limiter
+        self.metrics = metrics
+        self.codec = codec or DEFAULT_CODEC
+        self._urls = {}
+        self.compress_threshold = None
+        self.compression_stats = None
+        if compression:
+            self.compress_threshold = compress_threshold
+            self.compression_stats = CompressionStats()
+        self.cache = cache
+        self._singleflight = None
+        if coalesce_reads:
+            self._singleflight = SingleFlight()
+        if warm_up:
+            self.warm_up()
+
+    @property
+    def auth(self):
+        """
+        The requests authentication handler, created on first use.
+
+        A single handler is shared by every request, and the session keeps
+        any cookie the server sets once negotiation succeeds, so later
+        requests reuse the authenticated server session and only negotiate
+        again when the server answers 401.
+        """
+        if self._auth is DEFAULT_AUTH:
+            with self._auth_lock:
+                if self._auth is DEFAULT_AUTH:
+                    self._auth = HTTPDefaultAuth()
+        return self._auth
+
+    @auth.setter
+    def auth(self, auth):
+        self._auth = auth
+
+    def warm_up(self):
+        """
+        Open a connection and complete authentication with a cheap lookup of
+        the 'etc' stem, so the first real request does not pay for it.
+        """
+        return self.find_stems(FindStemByName(stem_name='etc'))
 
     def request(self, method, url, data):
         """
         Perform an authenticated request against the remote Grouper instance.
+
+        method is an HTTP method name or the matching requests.Session method.
+        Identical concurrent reads are coalesced with coalesce_reads; every
+        caller then gets the same response object, which should be treated
+        as read-only.
         """
-        headers = {
-            'Content-type': 'text/x-json',
-        }
-        real_url = urljoin(self.base_url, url)
-        http_response = method(
-            real_url,
-            headers=headers,
-            data=json.dumps(data),
-            auth=self.auth
-        )
+        if not isinstance(method, six.string_types):
+            method = method.__name__
+        real_url = self._urls.get(url)
+        if real_url is None:
+            if len(self._urls) >= URL_CACHE_SIZE:
+                self._urls.clear()
+            real_url = self._urls[url] = urljoin(self.base_url, url)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(json.dumps(data, indent=2))
+        if self._singleflight is not None and is_read_request(data):
+            key = (method, real_url, json.dumps(data, sort_keys=True))
+            shared = [True]
+            def send():
+                shared[0] = False
+                return self._send(method, real_url, data)
+            response = self._singleflight.do(key, send)
+            if shared[0] and self.metrics is not None:
+                self.metrics.record_cache_hit('singleflight')
+            return response
+        return self._send(method, real_url, data)
+
+    def _send(self, method, real_url, data):
+        body = self.codec.dumps(data)
+        headers = JSON_HEADERS
+        sent = body
+        if self.compress_threshold is not None and len(body) >= self.compress_threshold:
+            sent = gzip_bytes(body)
+            headers = GZIP_JSON_HEADERS
+        retryable = is_read_request(data)
+        if self.limiter is not None:
+            self.limiter.acquire()
+        started = time.time()
+        failed = True
+        overloaded = False
+        http_response = None
+        try:
+            # Worked out per copy, so a hedged copy gets only what is left
+            def send():
+                return self.transport.send(
+                    method, real_url, headers, sent, auth=self.auth,
+                    retryable=retryable, timeout=request_timeout(self.timeout)
+                )
+            if self._hedger is not None and retryable:
+                http_response = self._hedger.call(request_endpoint(data), send)
+            else:
+                http_response = send()
+            failed = http_response.status_code >= 500
+            overloaded = host_failed(http_response)
+        except CONNECTION_ERRORS:
+            # A timeout cut short by the caller's deadline says nothing
+            # about the load on Grouper
+            left = remaining()
+            overloaded = left is None or left > 0
+            raise
+        finally:
+            latency = time.time() - started
+            if self.limiter is not None:
+                self.limiter.release(latency, overloaded)
+            if self.metrics is not None and http_response is None:
+                self.metrics.record_request(request_endpoint(data), latency, len(sent), failed=True)
         logger.debug(http_response)
-        return http_response.json()
+        content = http_response.content
+        if self.compression_stats is not None:
+            received = wire_size(http_response)
+            self.compression_stats.record(
+                len(body), len(sent), len(content),
+                len(content) if received is None else received
+            )
+        response = None
+        try:
+            response = self.codec.loads(content)
+        finally:
+            # An undecodable body, such as a proxy's HTML error page, counts
+            # as a failed request
+            if self.metrics is not None:
+                self.metrics.record_request(
+                    request_endpoint(data), latency, len(sent), len(content),
+                    None if response is None else result_code(response),
+                    failed or response is None
+                )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(json.dumps(response, indent=2))
+        return response
+
+    def write_behind(self, **kwargs):
+        """
+        Return a MembershipWriteBuffer which batches membership mutations
+        made through this client; see writebehind.MembershipWriteBuffer.
+        """
+        from .writebehind import MembershipWriteBuffer
+        return MembershipWriteBuffer(self, **kwargs)
 
     def add_members(self, group, members, replace_existing=False):
         if isinstance(group, Group):
             group = group.group_name
 
-        url = 'servicesRest/v2_1_005/groups/{0}/members'.format(quote(group, safe=''))
+        url = group_url(group, 'members')
 
         members_list = [member_to_subject_lookup(member) for member in members]
 
@@ -113,16 +341,14 @@ class Grouper(object):
                 'subjectLookups': members_list,
             },
         }
-        logger.debug(json.dumps(data, indent=2))
         response = self.request(self._session.put, url, data)
-        logger.debug(json.dumps(response, indent=2))
         return response
 
     def delete_members(self, group, members):
         if isinstance(group, Group):
             group = group.group_name
 
-        url = 'servicesRest/v2_1_005/groups/{0}/members'.format(quote(group, safe=''))
+        url = group_url(group, 'members')
 
         members_list = [member_to_subject_lookup(member) for member in members]
 
@@ -131,9 +357,7 @@ class Grouper(object):
                 'subjectLookups': members_list,
             },
         }
-        logger.debug(json.dumps(data, indent=2))
         response = self.request(self._session.post, url, data)
-        logger.debug(json.dumps(response, indent=2))
         return response
 
     def find_groups(self, query):
@@ -144,9 +368,7 @@ class Grouper(object):
                 'wsQueryFilter': query.to_json_dict(),
             },
         }
-        logger.debug(json.dumps(data, indent=2))
         response = self.request(self._session.post, url, data)
-        logger.debug(json.dumps(response, indent=2))
         return response
 
     def find_stems(self, query):
@@ -157,13 +379,58 @@ class Grouper(object):
                 'wsStemQueryFilter': query.to_json_dict(),
             },
         }
-        logger.debug(json.dumps(data, indent=2))
         response = self.request(self._session.post, url, data)
-        logger.debug(json.dumps(response, indent=2))
         return response
 
+    def _cache_lookup(self, kind, keys):
+        cached = self.cache.get_many(set(keys))
+        if cached and self.metrics is not None:
+            self.metrics.record_cache_hit(kind, len(cached))
+        return cached
+
     def lookup_groups(self, groups):
+        """
+        Look up groups by name, with details.
+
+        If the client has a cache (see cache.SharedCache), groups found in it
+        are not requested again, and groups returned by Grouper are added to
+        it. Groups which are not found are never cached.
+        """
         url = 'servicesRest/v2_1_005/groups/'
+        if self.cache is None:
+            return self._lookup_groups(url, groups)
+
+        groups = list(groups)
+        keys = [cache_key('groups', group) for group in groups]
+        cached = self._cache_lookup('group_lookup', keys)
+        missing = []
+        for group, key in zip(groups, keys):
+            if key not in cached and group not in missing:
+                missing.append(group)
+
+        if missing or not groups:
+            response = self._lookup_groups(url, missing)
+            results = response['WsFindGroupsResults']
+            fetched = dict(
+                (cache_key('groups', result['name']), result)
+                for result in results.get('groupResults', [])
+            )
+            self.cache.set_many(fetched)
+            if not cached:
+                return response
+            cached.update(fetched)
+        else:
+            results = {
+                'resultMetadata': {'success': 'T', 'resultCode': 'SUCCESS'},
+            }
+
+        # Rebuild the results in the order requested, without changing a
+        # response which may be shared with other callers
+        results = dict(results)
+        results['groupResults'] = [cached[key] for key in keys if key in cached]
+        return {'WsFindGroupsResults': results}
+
+    def _lookup_groups(self, url, groups):
         group_list = [{'groupName': group} for group in groups]
 
         data = {
@@ -172,16 +439,14 @@ class Grouper(object):
                 'includeGroupDetail': 'T',
             },
         }
-        logger.debug(json.dumps(data, indent=2))
         response = self.request(self._session.post, url, data)
-        logger.debug(json.dumps(response, indent=2))
         return response
 
     def has_members(self, group, members):
         if isinstance(group, Group):
             group = group.group_name
 
-        url = 'servicesRest/v2_1_005/groups/{0}/members'.format(quote(group, safe=''))
+        url = group_url(group, 'members')
 
         members_list = [member_to_subject_lookup(member) for member in members]
 
@@ -190,9 +455,7 @@ class Grouper(object):
                 'subjectLookups': members_list,
             },
         }
-        logger.debug(json.dumps(data, indent=2))
         response = self.request(self._session.put, url, data)
-        logger.debug(json.dumps(response, indent=2))
         return response
 
     def get_members(self, groups, subject_attributes=DEFAULT_SUBJECT_ATTRIBUTES,
@@ -212,32 +475,97 @@ class Grouper(object):
                 page = 1
             data['WsRestGetMembersRequest']['pageSize'] = str(page_size)
             data['WsRestGetMembersRequest']['pageNumber'] = str(page)
-        logger.debug(json.dumps(data, indent=2))
         response = self.request(self._session.post, url, data)
-        logger.debug(json.dumps(response, indent=2))
         return response
 
     def get_subjects(self, subjects, subject_attributes=DEFAULT_SUBJECT_ATTRIBUTES):
+        """
+        Look up subjects with the given attributes.
+
+        If the client has a cache (see cache.SharedCache), subjects found in
+        it are not requested again, and subjects Grouper finds are added to
+        it, keyed by lookup and attribute names.
+        """
         url = 'servicesRest/v2_1_005/subjects'
 
         subjects_list = [member_to_subject_lookup(subject) for subject in subjects]
-
+        if self.cache is None:
+            return self._get_subjects(url, subjects_list, subject_attributes)
+
+        keys = [cache_key('subjects', lookup, subject_attributes) for lookup in subjects_list]
+        cached = self._cache_lookup('subject_lookup', keys)
+        missing = []
+        missing_keys = []
+        for lookup, key in zip(subjects_list, keys):
+            if key not in cached and key not in missing_keys:
+                missing.append(lookup)
+                missing_keys.append(key)
+
+        if missing or not subjects_list:
+            response = self._get_subjects(url, missing, subject_attributes)
+            results = response['WsGetSubjectsResults']
+            attribute_names = results.get('subjectAttributeNames', [])
+            fetched = results.get('wsSubjects', [])
+            if len(fetched) != len(missing):
+                # Cannot pair results with lookups, so cache nothing
+                return response
+            found = {}
+            for key, subject in zip(missing_keys, fetched):
+                cached[key] = found[key] = {
+                    'subjectAttributeNames': attribute_names,
+                    'wsSubject': subject,
+                }
+                if subject.get('success', 'T') != 'T':
+                    del found[key]
+            self.cache.set_many(found)
+            if len(missing) == len(keys):
+                return response
+        else:
+            results = {
+                'resultMetadata': {'success': 'T', 'resultCode': 'SUCCESS'},
+            }
+
+        results = dict(results)
+        results['subjectAttributeNames'] = cached[keys[0]]['subjectAttributeNames']
+        results['wsSubjects'] = [cached[key]['wsSubject'] for key in keys]
+        return {'WsGetSubjectsResults': results}
+
+    def _get_subjects(self, url, subjects_list, subject_attributes):
         data = {
             'WsRestGetSubjectsRequest': {
                 'subjectAttributeNames': subject_attributes,
                 'wsSubjectLookups': subjects_list,
             },
         }
-        logger.debug(json.dumps(data, indent=2))
         response = self.request(self._session.put, url, data)
-        logger.debug(json.dumps(response, indent=2))
+        return response
+
+    def search_subjects(self, search_string, subject_attributes=DEFAULT_SUBJECT_ATTRIBUTES,
+                        source_ids=None, page_size=None, page=1):
+        url = 'servicesRest/v2_1_005/subjects'
+
+        data = {
+            'WsRestGetSubjectsRequest': {
+                'searchString': search_string,
+                'subjectAttributeNames': subject_attributes,
+                'includeSubjectDetail': 'T',
+            },
+        }
+        if source_ids is not None:
+            data['WsRestGetSubjectsRequest']['sourceIds'] = list(source_ids)
+        if page_size is not None:
+            if page < 1:
+                page = 1
+            data['WsRestGetSubjectsRequest']['pageSize'] = str(page_size)
+            data['WsRestGetSubjectsRequest']['pageNumber'] = str(page)
+        response = self.request(self._session.put, url, data)
         return response
 
     def get_group_memberships(self, group, member_filter='All', subject_attributes=DEFAULT_SUBJECT_ATTRIBUTES, details=True):
         if isinstance(group, Group):
             group = group.group_name
 
-        url = 'servicesRest/v2_1_005/groups/{0}/memberships'.format(quote(group, safe=''))
+        url = group_url(group, 'memberships')
         member_filter_values = ['All', 'Effective', 'Immediate', 'Composite', 'NonImmediate']
         if member_filter not in member_filter_values:
             raise Exception("member_filter must be in '{0}'".format(member_filter_values))
@@ -245,14 +573,12 @@ class Grouper(object):
         data = {
             'WsRestGetMembershipsRequest': {
                 'subjectAttributeNames': subject_attributes,
-                'memberFilter': 'All',
+                'memberFilter': member_filter,
                 'includeGroupDetail': 'T',
                 'includeSubjectDetail': bool_to_tf_str(details),
             },
         }
-        logger.debug(json.dumps(data, indent=2))
         response = self.request(self._session.post, url, data)
-        logger.debug(json.dumps(response, indent=2))
         return response
 
     def get_memberships_for_subjects(
@@ -270,7 +596,7 @@ class Grouper(object):
 
         params = {
             'subjectAttributeNames': subject_attributes,
-            'memberFilter': 'All',
+            'memberFilter': member_filter,
             'includeGroupDetail': bool_to_tf_str(group_details),
             'includeSubjectDetail': 'T',
             'wsSubjectLookups': members_list,
@@ -278,9 +604,7 @@ class Grouper(object):
         data = {
             'WsRestGetMembershipsRequest': params,
         }
-        logger.debug(json.dumps(data, indent=2))
         response = self.request(self._session.post, url, data)
-        logger.debug(json.dumps(response, indent=2))
         return response
 
     def save_groups(self, groups):
@@ -294,9 +618,7 @@ class Grouper(object):
                 'wsGroupToSaves': [g.to_json_dict() for g in groups],
             },
         }
-        logger.debug(json.dumps(data, indent=2))
         response = self.request(self._session.put, url, data)
-        logger.debug(json.dumps(response, indent=2))
         return response
 
     def save_stems(self, stems):
@@ -309,9 +631,7 @@ class Grouper(object):
                 'wsStemToSaves': [s.to_json_dict() for s in stems],
             },
         }
-        logger.debug(json.dumps(data, indent=2))
         response = self.request(self._session.put, url, data)
-        logger.debug(json.dumps(response, indent=2))
         return response
 
     def delete_groups(self, groups):
@@ -325,9 +645,7 @@ class Grouper(object):
                 'wsGroupLookups': [g.get_group_lookup() for g in groups],
             },
         }
-        logger.debug(json.dumps(data, indent=2))
         response = self.request(self._session.post, url, data)
-        logger.debug(json.dumps(response, indent=2))
         return response
 
     def delete_stems(self, stems):
@@ -340,9 +658,7 @@ class Grouper(object):
                 'wsStemLookups': [s.get_stem_lookup() for s in stems],
             },
         }
-        logger.debug(json.dumps(data, indent=2))
         response = self.request(self._session.post, url, data)
-        logger.debug(json.dumps(response, indent=2))
         return response
 
     def get_privileges(self, privilege_type=None, privilege_name=None,
@@ -374,9 +690,7 @@ class Grouper(object):
 
         data['WsRestGetGrouperPrivilegesLiteRequest'].update(params)
 
-        logger.debug(json.dumps(data, indent=2))
         response = self.request(self._session.post, url, data)
-        logger.debug(json.dumps(response, indent=2))
         return response
 
     def assign_privileges(self, privilege_type, privilege_names, allowed=True,
@@ -413,9 +727,7 @@ class Grouper(object):
 
         data['WsRestAssignGrouperPrivilegesRequest'].update(params)
 
-        logger.debug(json.dumps(data, indent=2))
         response = self.request(self._session.post, url, data)
-        logger.debug(json.dumps(response, indent=2))
         return response
 
     def assign_attributes(self, stems=None, groups=None, attribute_assigns=None, attributes={},
@@ -465,9 +777,7 @@ class Grouper(object):
 
         data['WsRestAssignAttributesRequest'].update(params)
 
-        logger.debug(json.dumps(data, indent=2))
         response = self.request(self._session.post, url, data)
-        logger.debug(json.dumps(response, indent=2))
         return response
 
     def get_attribute_assignments(self, stems=None, groups=None, attributes=None):
@@ -495,7 +805,5 @@ class Grouper(object):
 
         data['WsRestGetAttributeAssignmentsRequest'].update(params)
 
-        logger.debug(json.dumps(data, indent=2))
         response = self.request(self._session.post, url, data)
-        logger.debug(json.dumps(response, indent=2))
         return response
@@ -0,0 +1,152 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import csv
+import io
+import json
+import logging
+import os
+
+import six
+
+from . import queries
+from . import stem_queries
+from .bulk import run_concurrently, DEFAULT_MAX_WORKERS
+
+
+PRIVILEGE_EXPORT_FIELDS = [
+    'object_type',
+    'object_name',
+    'privilege_type',
+    'privilege_name',
+    'allowed',
+    'subject_id',
+    'subject_source_id',
+    'subject_name',
+]
+
+EXPORT_FORMATS = ['ndjson', 'csv']
+
+logger = logging.getLogger(__name__)
+
+
+def find_subtree(grouper, root_stem):
+    """
+    Return (stem names, group names) for everything below root_stem,
+    including root_stem itself.
+    """
+    response = grouper.find_stems(
+        stem_queries.FindByParentStemName(root_stem, stem_name=None, recursive=True)
+    )
+    stem_results = response['WsFindStemsResults'].get('stemResults', [])
+    stems = set(s['name'] for s in stem_results)
+    stems.add(root_stem)
+
+    response = grouper.find_groups(queries.FindByStemName(root_stem, recursive=True))
+    group_results = response['WsFindGroupsResults'].get('groupResults', [])
+    groups = set(g['name'] for g in group_results)
+    return sorted(stems), sorted(groups)
+
+
+def privilege_rows(object_type, object_name, response):
+    """
+    Normalise a get_privileges() response into flat export rows.
+    """
+    results = response.get('WsGetGrouperPrivilegesLiteResult', {})
+    for result in results.get('privilegeResults', []):
+        subject = result.get('wsSubject', {})
+        yield {
+            'object_type': object_type,
+            'object_name': object_name,
+            'privilege_type': result.get('privilegeType'),
+            'privilege_name': result.get('privilegeName'),
+            'allowed': result.get('allowed'),
+            'subject_id': subject.get('id'),
+            'subject_source_id': subject.get('sourceId'),
+            'subject_name': subject.get('name'),
+        }
+
+
+def _encode_rows(rows, export_format, header):
+    buf = six.StringIO()
+    if export_format == 'csv':
+        writer = csv.DictWriter(buf, PRIVILEGE_EXPORT_FIELDS, lineterminator='\n')
+        if header:
+            writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            buf.write(json.dumps(row, sort_keys=True))
+            buf.write('\n')
+    return buf.getvalue().encode('utf-8')
+
+
+def _read_checkpoint(checkpoint_path):
+    """
+    Return (completed objects, output offset) recorded by a previous export.
+    """
+    done = set()
+    offset = 0
+    if not os.path.exists(checkpoint_path):
+        return done, offset
+    with io.open(checkpoint_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) != 3:
+                # Torn final line from an interrupted run
+                continue
+            offset = int(parts[0])
+            done.add((parts[1], parts[2]))
+    return done, offset
+
+
+def export_privileges(grouper, root_stem, path, export_format='ndjson',
+                      resume=False, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Stream every privilege on every stem and group below root_stem to path.
+
+    Privileges are fetched concurrently and written as each object
+    completes, so memory use does not grow with the size of the export.
+    Progress is recorded in path + '.checkpoint'; with resume, objects
+    already exported are skipped and any partially written output is
+    truncated away. Returns the number of rows written by this call.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise Exception("export_format must be in '{0}'".format(EXPORT_FORMATS))
+
+    checkpoint_path = path + '.checkpoint'
+    done, offset = set(), 0
+    if resume:
+        done, offset = _read_checkpoint(checkpoint_path)
+    else:
+        for stale in (path, checkpoint_path):
+            if os.path.exists(stale):
+                os.remove(stale)
+
+    stems, groups = find_subtree(grouper, root_stem)
+    objects = [('stem', name) for name in stems] + [('group', name) for name in groups]
+    objects = [obj for obj in objects if obj not in done]
+    logger.debug("Exporting privileges for {0} objects ({1} already done)".format(
+        len(objects), len(done)
+    ))
+
+    def fetch(obj):
+        object_type, object_name = obj
+        response = grouper.get_privileges(**{object_type: object_name})
+        return list(privilege_rows(object_type, object_name, response))
+
+    written = 0
+    mode = 'r+b' if os.path.exists(path) else 'wb'
+    with open(path, mode) as out, io.open(checkpoint_path, 'a', encoding='utf-8') as checkpoint:
+        out.seek(offset)
+        out.truncate()
+        for obj, rows, error in run_concurrently(fetch, objects, max_workers):
+            if error is not None:
+                raise error
+            out.write(_encode_rows(rows, export_format, header=out.tell() == 0))
+            out.flush()
+            checkpoint.write(u'{0}\t{1}\t{2}\n'.format(out.tell(), obj[0], obj[1]))
+            checkpoint.flush()
+            written += len(rows)
+    return written
@@ -0,0 +1,492 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logging
+
+import six
+
+from .api import member_to_subject_lookup, str_to_group, str_to_stem
+from .deadlines import with_current_deadline
+from .results import call_with_retry, BulkResult
+
+
+DEFAULT_CHUNK_SIZE = 100
+DEFAULT_MAX_WORKERS = 4
+
+logger = logging.getLogger(__name__)
+
+
+def chunked(items, size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield successive lists of at most size items from any iterable.
+    """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run_concurrently(func, items, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Call func(item) for every item on a thread pool, yielding
+    (item, result, exception) tuples in completion order.
+
+    Items are consumed lazily so that at most 2 * max_workers calls are
+    queued at any one time. Calls run under the caller's deadline, if any.
+    """
+    func = with_current_deadline(func)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = {}
+
+    def drain(return_when):
+        done, _ = wait(list(pending), return_when=return_when)
+        for future in done:
+            item = pending.pop(future)
+            try:
+                yield item, future.result(), None
+            except Exception as e:
+                yield item, None, e
+
+    try:
+        for item in items:
+            pending[executor.submit(func, item)] = item
+            if len(pending) >= max_workers * 2:
+                for outcome in drain(FIRST_COMPLETED):
+                    yield outcome
+        while pending:
+            for outcome in drain(FIRST_COMPLETED):
+                yield outcome
+    finally:
+        executor.shutdown(wait=True)
+
+
+def plan_group_levels(groups):
+    """
+    Split groups into a list of levels such that the factors of every
+    composite group are saved in an earlier level than the composite.
+
+    Factors which are not themselves in groups are assumed to exist already.
+    """
+    groups = [str_to_group(group) for group in groups]
+    by_name = {}
+    for group in groups:
+        by_name[group.group_name] = group
+
+    depends_on = {}
+    for name, group in by_name.items():
+        deps = set()
+        if group.is_composite():
+            for factor in (group.left_group, group.right_group):
+                if factor.group_name in by_name:
+                    deps.add(factor.group_name)
+        depends_on[name] = deps
+
+    levels = []
+    placed = set()
+    remaining = set(by_name)
+    while remaining:
+        level = sorted(name for name in remaining if depends_on[name] <= placed)
+        if not level:
+            raise Exception("plan_group_levels(): Composite cycle between {0}".format(
+                sorted(remaining)
+            ))
+        levels.append([by_name[name] for name in level])
+        placed.update(level)
+        remaining.difference_update(level)
+    return levels
+
+
+def run_chunks_checked(func, chunks, max_workers=DEFAULT_MAX_WORKERS,
+                       describe=None, error="Bulk operation failed"):
+    """
+    Call func(chunk) concurrently for every chunk, where func returns a
+    BulkResult, and return the list of BulkResults.
+
+    An exception from any call is raised. Once every chunk has finished, any
+    items which still failed are raised as an Exception starting with error
+    and listing describe(chunk, item) (by default str(item)) for each.
+    """
+    results = []
+    failures = []
+    for chunk, result, exception in run_concurrently(func, chunks, max_workers):
+        if exception is not None:
+            raise exception
+        results.append(result)
+        failures.extend(
+            str(item.item) if describe is None else describe(chunk, item.item)
+            for item in result.failed()
+        )
+    if failures:
+        raise Exception("{0}: {1}".format(error, failures))
+    return results
+
+
+def save_groups_ordered(grouper, groups, chunk_size=DEFAULT_CHUNK_SIZE,
+                        max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Save groups and composite groups in dependency order.
+
+    Each level of plan_group_levels() is saved in concurrent chunks, so the
+    number of sequential round trips is the depth of the composite graph.
+    Groups which fail transiently are resent on their own. Returns the list
+    of save_groups_checked() BulkResults.
+    """
+    results = []
+    for depth, level in enumerate(plan_group_levels(groups)):
+        logger.debug("Saving level {0}: {1} groups".format(depth, len(level)))
+        results.extend(run_chunks_checked(
+            lambda chunk: save_groups_checked(grouper, chunk),
+            chunked(level, chunk_size), max_workers,
+            describe=lambda chunk, group: group.group_name,
+            error="save_groups_ordered(): Level {0} failed".format(depth)
+        ))
+    return results
+
+
+def held_privileges(response):
+    """
+    Extract a set of (privilege_name, subject_id, source_id) tuples from a
+    get_privileges() response, counting only allowed privileges.
+    """
+    results = response.get('WsGetGrouperPrivilegesLiteResult', {})
+    held = set()
+    for result in results.get('privilegeResults', []):
+        if result.get('allowed', 'T') != 'T':
+            continue
+        subject = result.get('wsSubject', {})
+        held.add((result.get('privilegeName'), subject.get('id'), subject.get('sourceId')))
+    return held
+
+
+def _privilege_held(held, privilege_name, lookup):
+    subject_id = lookup.get('subjectId')
+    if subject_id is None:
+        # Identifier lookups cannot be compared with the IDs Grouper returns
+        return None
+    source_id = lookup.get('subjectSourceId')
+    for name, held_id, held_source in held:
+        if name == privilege_name and held_id == subject_id and \
+                (source_id is None or source_id == held_source):
+            return True
+    return False
+
+
+def privilege_failures(response):
+    """
+    Return (subject, privilege_name, result_code) for every failed item of
+    an assign_privileges() response. If the response as a whole failed
+    without saying which items, a single (None, None, result_code) entry
+    is returned.
+    """
+    results = {}
+    for value in response.values():
+        if isinstance(value, dict):
+            results = value
+            break
+    failures = []
+    for result in results.get('results', []):
+        metadata = result.get('resultMetadata', {})
+        if metadata.get('success') != 'T':
+            subject = result.get('wsSubject', {})
+            failures.append((
+                subject.get('id') or subject.get('identifierLookup'),
+                result.get('privilegeName'),
+                metadata.get('resultCode'),
+            ))
+    metadata = results.get('resultMetadata', {})
+    if not failures and metadata.get('success') != 'T':
+        failures.append((None, None, metadata.get('resultCode')))
+    return failures
+
+
+def assign_privileges_bulk(grouper, privilege_type, privilege_names, members,
+                           stems=None, groups=None, allowed=True,
+                           check_existing=True, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Grant (or revoke, if allowed is False) privilege_names to members on
+    every one of stems or groups.
+
+    With check_existing, the current privileges of each target are fetched
+    first and only the grants which would change something are sent;
+    subjects given by identifier cannot be compared, so are always sent.
+    Returns a dict of target name to a result dict with 'skipped',
+    'responses', 'failed' (see privilege_failures()) and 'error' keys.
+    """
+    if stems is not None:
+        targets = [('stem', str_to_stem(stem).stem_name) for stem in stems]
+    elif groups is not None:
+        targets = [('group', str_to_group(group).group_name) for group in groups]
+    else:
+        raise Exception("assign_privileges_bulk(): No stems or groups specified!")
+    members = list(members)
+    lookups = [member_to_subject_lookup(member) for member in members]
+
+    def assign_target(target):
+        kind, name = target
+        pending = {}
+        if check_existing:
+            held = held_privileges(grouper.get_privileges(
+                privilege_type=privilege_type, **{kind: name}
+            ))
+            for privilege_name in privilege_names:
+                wanted = tuple(
+                    i for i, lookup in enumerate(lookups)
+                    if _privilege_held(held, privilege_name, lookup) in (None, not allowed)
+                )
+                if wanted:
+                    pending.setdefault(wanted, []).append(privilege_name)
+        else:
+            pending[tuple(range(len(members)))] = list(privilege_names)
+
+        # One request per distinct set of subjects still needing a change
+        responses = []
+        for indices, names in pending.items():
+            responses.append(grouper.assign_privileges(
+                privilege_type, names, allowed=allowed,
+                members=[members[i] for i in indices], **{kind: name}
+            ))
+        return responses
+
+    results = {}
+    for target, responses, error in run_concurrently(assign_target, targets, max_workers):
+        failed = []
+        for response in responses or []:
+            failed.extend(privilege_failures(response))
+        if error is None and failed:
+            error = Exception("Failed for {0}".format(failed))
+        results[target[1]] = {
+            'skipped': error is None and not responses,
+            'responses': responses or [],
+            'failed': failed,
+            'error': error,
+        }
+        if error is not None:
+            logger.warning("Privilege assignment on {0} failed: {1}".format(target[1], error))
+    return results
+
+
+def get_memberships_index(grouper, members, member_filter='All',
+                          chunk_size=DEFAULT_CHUNK_SIZE, max_workers=DEFAULT_MAX_WORKERS,
+                          reverse=False):
+    """
+    Look up the groups of many subjects using concurrent chunked
+    get_memberships_for_subjects() calls.
+
+    Returns a dict of subject ID to a set of group names. With reverse, a
+    tuple of that dict and a dict of group name to a set of subject IDs is
+    returned instead.
+    """
+    members = list(members)
+    index = {}
+    for member in members:
+        subject_id = member_to_subject_lookup(member).get('subjectId')
+        if subject_id is not None:
+            index[subject_id] = set()
+
+    def fetch(chunk):
+        return grouper.get_memberships_for_subjects(
+            chunk, member_filter=member_filter, subject_attributes=[]
+        )
+
+    for chunk, response, error in run_concurrently(fetch, chunked(members, chunk_size), max_workers):
+        if error is not None:
+            raise error
+        results = response['WsGetMembershipsResults']
+        for membership in results.get('wsMemberships', []):
+            index.setdefault(membership['subjectId'], set()).add(membership['groupName'])
+
+    if not reverse:
+        return index
+    reverse_index = {}
+    for subject_id, group_names in index.items():
+        for group_name in group_names:
+            reverse_index.setdefault(group_name, set()).add(subject_id)
+    return index, reverse_index
+
+
+def _checked(grouper, func, items, endpoint, retry_kwargs):
+    retry_kwargs.setdefault('metrics', getattr(grouper, 'metrics', None))
+    return call_with_retry(func, items, endpoint=endpoint, **retry_kwargs)
+
+
+def add_members_checked(grouper, group, members, **retry_kwargs):
+    """
+    add_members() returning a BulkResult, resending transient failures.
+    """
+    return _checked(
+        grouper, lambda batch: grouper.add_members(group, batch),
+        members, 'WsRestAddMemberRequest', retry_kwargs
+    )
+
+
+def delete_members_checked(grouper, group, members, **retry_kwargs):
+    """
+    delete_members() returning a BulkResult, resending transient failures.
+    """
+    return _checked(
+        grouper, lambda batch: grouper.delete_members(group, batch),
+        members, 'WsRestDeleteMemberRequest', retry_kwargs
+    )
+
+
+def save_groups_checked(grouper, groups, **retry_kwargs):
+    """
+    save_groups() returning a BulkResult, resending transient failures.
+    """
+    return _checked(
+        grouper, grouper.save_groups, groups, 'WsRestGroupSaveRequest', retry_kwargs
+    )
+
+
+def save_stems_checked(grouper, stems, **retry_kwargs):
+    """
+    save_stems() returning a BulkResult, resending transient failures.
+    """
+    return _checked(
+        grouper, grouper.save_stems, stems, 'WsRestStemSaveRequest', retry_kwargs
+    )
+
+
+def assign_attributes_checked(grouper, stems=None, groups=None, **kwargs):
+    """
+    assign_attributes() on many owners returning a BulkResult with one item
+    per owner, resending owners which failed transiently.
+    """
+    retry_kwargs = {}
+    for key in ('max_retries', 'backoff', 'metrics'):
+        if key in kwargs:
+            retry_kwargs[key] = kwargs.pop(key)
+    if stems is not None:
+        func = lambda batch: grouper.assign_attributes(stems=batch, **kwargs)
+        owners = stems
+    else:
+        func = lambda batch: grouper.assign_attributes(groups=batch, **kwargs)
+        owners = groups
+    return _checked(grouper, func, owners, 'WsRestAssignAttributesRequest', retry_kwargs)
+
+
+def delete_groups_checked(grouper, groups, **retry_kwargs):
+    """
+    delete_groups() returning a BulkResult, resending transient failures.
+    """
+    return _checked(
+        grouper, grouper.delete_groups, groups, 'WsRestGroupDeleteRequest', retry_kwargs
+    )
+
+
+def delete_stems_checked(grouper, stems, **retry_kwargs):
+    """
+    delete_stems() returning a BulkResult, resending transient failures.
+    """
+    return _checked(
+        grouper, grouper.delete_stems, stems, 'WsRestStemDeleteRequest', retry_kwargs
+    )
+
+
+def attribute_values_index(response):
+    """
+    Map (owner name, attribute name) to the list of values assigned, from a
+    get_attribute_assignments() response. Assignments on assignments are
+    left out.
+    """
+    index = {}
+    results = response['WsGetAttributeAssignmentsResults']
+    for assign in results.get('wsAttributeAssigns', []):
+        if 'ownerAttributeAssignId' in assign:
+            continue
+        owner = assign.get('ownerGroupName') or assign.get('ownerStemName')
+        values = index.setdefault((owner, assign['attributeDefNameName']), [])
+        values.extend(
+            value.get('valueSystem') for value in assign.get('wsAttributeAssignValues', [])
+        )
+    return index
+
+
+def assign_attribute_values(grouper, stems=None, groups=None, check_existing=True,
+                            attr_value_op='replace_values', chunk_size=DEFAULT_CHUNK_SIZE,
+                            max_workers=DEFAULT_MAX_WORKERS, **retry_kwargs):
+    """
+    Set a separate attribute value on each owner, given an iterable of
+    (owner, attribute name, value) triples as stems or groups. If an owner
+    and attribute appear more than once, the last value is used.
+
+    With check_existing, current values are fetched in concurrent chunked
+    get_attribute_assignments() calls and owners which already have exactly
+    that value are skipped. The rest are grouped by (attribute, value) and
+    sent as concurrent chunked assign_attributes() calls, so owners sharing
+    a value share a request; transient failures are resent on their own.
+
+    Returns (results, unchanged): a dict of (attribute, value) to a BulkResult
+    whose items are owner names, and the list of triples skipped.
+    """
+    if stems is not None:
+        kind, triples = 'stems', [(str_to_stem(o).stem_name, a, v) for o, a, v in stems]
+    elif groups is not None:
+        kind, triples = 'groups', [(str_to_group(o).group_name, a, v) for o, a, v in groups]
+    else:
+        raise Exception("assign_attribute_values(): No stems or groups specified!")
+
+    current = {}
+    if check_existing:
+        owners = sorted(set(owner for owner, _, _ in triples))
+        attributes = sorted(set(attribute for _, attribute, _ in triples))
+
+        def fetch(chunk):
+            return grouper.get_attribute_assignments(attributes=attributes, **{kind: chunk})
+
+        for chunk, response, error in run_concurrently(fetch, chunked(owners, chunk_size), max_workers):
+            if error is not None:
+                raise error
+            current.update(attribute_values_index(response))
+
+    # The last value given for an owner and attribute wins
+    wanted = OrderedDict()
+    for owner, attribute, value in triples:
+        if value is not None and not isinstance(value, six.string_types):
+            value = str(value)
+        wanted.pop((owner, attribute), None)
+        wanted[(owner, attribute)] = value
+
+    pending = {}
+    unchanged = []
+    for (owner, attribute), value in wanted.items():
+        if current.get((owner, attribute)) == [value]:
+            unchanged.append((owner, attribute, value))
+            continue
+        pending.setdefault((attribute, value), []).append(owner)
+
+    def assign(work):
+        (attribute, value), chunk = work
+        return assign_attributes_checked(
+            grouper, attributes={attribute: value}, attr_value_op=attr_value_op,
+            **dict(retry_kwargs, **{kind: chunk})
+        )
+
+    work = [
+        (key, chunk)
+        for key in sorted(pending, key=lambda key: (key[0], key[1] or ''))
+        for chunk in chunked(pending[key], chunk_size)
+    ]
+    results = {}
+    for (key, _), result, error in run_concurrently(assign, work, max_workers):
+        if error is not None:
+            raise error
+        merged = results.get(key)
+        if merged is None:
+            results[key] = result
+        else:
+            results[key] = BulkResult(
+                merged.items + result.items, merged.responses + result.responses,
+                max(merged.attempts, result.attempts)
+            )
+    logger.debug("Assigned {0} attribute values, {1} unchanged".format(
+        sum(len(owners) for owners in pending.values()), len(unchanged)
+    ))
+    return results, unchanged
@@ -0,0 +1,173 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import OrderedDict
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+
+DEFAULT_CACHE_TTL = 300
+DEFAULT_CACHE_SIZE = 10000
+
+# Number of writes between sweeps of expired and excess entries
+EVICTION_INTERVAL = 100
+
+# SQLite limits the number of parameters in one statement
+MAX_KEYS_PER_QUERY = 500
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(*parts):
+    return json.dumps(parts, sort_keys=True, separators=(',', ':'))
+
+
+class MemoryCache(object):
+    """
+    LRU cache of JSON-compatible values for a single process.
+
+    Values are stored by reference and must be treated as read-only.
+    """
+    def __init__(self, ttl=DEFAULT_CACHE_TTL, max_entries=DEFAULT_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get_many(self, keys):
+        now = time.time()
+        found = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                if entry[0] <= now:
+                    del self._entries[key]
+                    continue
+                self._entries.pop(key)
+                self._entries[key] = entry
+                found[key] = entry[1]
+        return found
+
+    def set_many(self, values):
+        expires = time.time() + self.ttl
+        with self._lock:
+            for key, value in values.items():
+                self._entries.pop(key, None)
+                self._entries[key] = (expires, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SharedCache(object):
+    """
+    Cache of JSON-compatible values in an SQLite file, shared by every
+    process on the host which opens the same path.
+
+    Entries expire ttl seconds after they are written. Every
+    EVICTION_INTERVAL writes, a process removes expired entries and then the
+    oldest ones beyond max_entries. Each thread of each process uses its own
+    connection, opened on first use, so a cache created before a fork (as
+    in a preloading gunicorn master) is safe to use in the workers. Errors
+    from the database are logged and treated as misses.
+    """
+    def __init__(self, path, ttl=DEFAULT_CACHE_TTL, max_entries=DEFAULT_CACHE_SIZE,
+                 timeout=5.0):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._local = threading.local()
+        self._writes = 0
+        self._writes_lock = threading.Lock()
+        with self._connect() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS cache ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)'
+            )
+            connection.execute('CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)')
+
+    def _connect(self):
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            # WAL lets readers in other processes carry on during writes
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = pid
+        return self._local.connection
+
+    def get_many(self, keys):
+        keys = list(keys)
+        found = {}
+        now = time.time()
+        try:
+            connection = self._connect()
+            for start in range(0, len(keys), MAX_KEYS_PER_QUERY):
+                batch = keys[start:start + MAX_KEYS_PER_QUERY]
+                rows = connection.execute(
+                    'SELECT key, value FROM cache WHERE expires > ? AND key IN ({0})'.format(
+                        ','.join('?' * len(batch))
+                    ),
+                    [now] + batch
+                )
+                for key, value in rows:
+                    found[key] = json.loads(value)
+        except sqlite3.Error as e:
+            logger.warning("Shared cache read failed: {0}".format(e))
+        return found
+
+    def set_many(self, values):
+        if not values:
+            return
+        expires = time.time() + self.ttl
+        rows = [
+            (key, json.dumps(value, separators=(',', ':')), expires)
+            for key, value in values.items()
+        ]
+        try:
+            with self._connect() as connection:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)', rows
+                )
+        except sqlite3.Error as e:
+            logger.warning("Shared cache write failed: {0}".format(e))
+            return
+        with self._writes_lock:
+            self._writes += len(rows)
+            evict = self._writes >= EVICTION_INTERVAL
+            if evict:
+                self._writes = 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """
+        Remove expired entries, then the entries closest to expiry until at
+        most max_entries remain.
+        """
+        try:
+            with self._connect() as connection:
+                connection.execute('DELETE FROM cache WHERE expires <= ?', (time.time(),))
+                connection.execute(
+                    'DELETE FROM cache WHERE key IN ('
+                    'SELECT key FROM cache ORDER BY expires DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries,)
+                )
+        except sqlite3.Error as e:
+            logger.warning("Shared cache eviction failed: {0}".format(e))
+
+    def clear(self):
+        with self._connect() as connection:
+            connection.execute('DELETE FROM cache')
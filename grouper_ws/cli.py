@@ -0,0 +1,205 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import sys
+import time
+
+from .api import Grouper
+from .bulk import add_members_checked, run_concurrently, \
+    DEFAULT_CHUNK_SIZE, DEFAULT_MAX_WORKERS
+
+
+logger = logging.getLogger(__name__)
+
+
+def read_membership_rows(path, file_format=None):
+    """
+    Stream (group, subject, source) tuples from a CSV or NDJSON file.
+
+    CSV files must have a header row naming the group and subject columns;
+    the source column is optional in both formats.
+    """
+    if file_format is None:
+        file_format = 'ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv'
+    with io.open(path, 'r', encoding='utf-8', newline='') as f:
+        if file_format == 'csv':
+            records = csv.DictReader(f)
+        else:
+            records = (json.loads(line) for line in f if line.strip())
+        for record in records:
+            yield record['group'], record['subject'], record.get('source') or None
+
+
+def membership_chunks(rows, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Group membership rows by target group, yielding (group, sequence, members)
+    chunks of at most chunk_size members.
+
+    Only one partial chunk per group is held in memory. The sequence number
+    counts chunks per group, so the same input and chunk size always produce
+    the same chunk identities.
+    """
+    pending = {}
+    sequence = {}
+    for group, subject, source in rows:
+        member = subject if source is None else (subject, source)
+        members = pending.setdefault(group, [])
+        members.append(member)
+        if len(members) >= chunk_size:
+            seq = sequence.get(group, 0)
+            sequence[group] = seq + 1
+            yield group, seq, pending.pop(group)
+    for group in sorted(pending):
+        yield group, sequence.get(group, 0), pending[group]
+
+
+class Checkpoint(object):
+    """
+    Append-only record of completed (group, sequence) chunks.
+    """
+    def __init__(self, path, chunk_size):
+        self.path = path
+        self.done = set()
+        header = u'chunk_size\t{0}\n'.format(chunk_size)
+        if path is not None and os.path.exists(path):
+            with io.open(path, 'r', encoding='utf-8') as f:
+                if f.readline() != header:
+                    raise Exception("Checkpoint {0} was written with a different chunk size".format(path))
+                for line in f:
+                    parts = line.rstrip('\n').split('\t')
+                    if len(parts) == 2:
+                        self.done.add((parts[0], int(parts[1])))
+            self._file = io.open(path, 'a', encoding='utf-8')
+        elif path is not None:
+            self._file = io.open(path, 'w', encoding='utf-8')
+            self._file.write(header)
+            self._file.flush()
+        else:
+            self._file = None
+
+    def __contains__(self, chunk_id):
+        return chunk_id in self.done
+
+    def record(self, group, sequence):
+        self.done.add((group, sequence))
+        if self._file is not None:
+            self._file.write(u'{0}\t{1}\n'.format(group, sequence))
+            self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def load_members(grouper, rows, chunk_size=DEFAULT_CHUNK_SIZE,
+                 max_workers=DEFAULT_MAX_WORKERS, checkpoint=None,
+                 progress=None, progress_interval=5.0):
+    """
+    Add membership rows through Grouper.add_members in concurrent chunks.
+
+    Subjects which fail transiently are resent on their own. Chunks listed in
+    checkpoint are skipped, and chunks with no transient failures left,
+    including chunks rejected outright, are recorded in it. Returns (members added, failed (group, subject) pairs).
+    """
+    if checkpoint is None:
+        checkpoint = Checkpoint(None, chunk_size)
+    chunks = (
+        chunk for chunk in membership_chunks(rows, chunk_size)
+        if (chunk[0], chunk[1]) not in checkpoint
+    )
+
+    def add_chunk(chunk):
+        group, _, members = chunk
+        return add_members_checked(grouper, group, members)
+
+    started = last_report = time.time()
+    added = 0
+    failed = []
+    for chunk, result, error in run_concurrently(add_chunk, chunks, max_workers):
+        group, sequence, members = chunk
+        if error is not None:
+            # Only errors which would recur on a resend reach here
+            logger.error("Chunk {0}#{1} failed: {2}".format(group, sequence, error))
+            failed.extend((group, member) for member in members)
+            checkpoint.record(group, sequence)
+            continue
+        added += len(result.succeeded())
+        for item in result.failed():
+            logger.error("Adding {0} to {1} failed: {2}".format(item.item, group, item.result_code))
+            failed.append((group, item.item))
+        if not result.transient_failures():
+            checkpoint.record(group, sequence)
+        now = time.time()
+        if progress is not None and now - last_report >= progress_interval:
+            last_report = now
+            progress(added, len(failed), now - started)
+    if progress is not None:
+        progress(added, len(failed), time.time() - started)
+    return added, failed
+
+
+def _report_progress(added, failed, elapsed):
+    rate = added / elapsed if elapsed > 0 else 0.0
+    print("{0} members added, {1} failed, {2:.1f} members/s".format(
+        added, failed, rate
+    ), file=sys.stderr)
+
+
+def _grouper_from_args(args):
+    kwargs = {}
+    if args.username is not None:
+        kwargs['auth'] = (args.username, os.environ.get('GROUPER_PASSWORD', ''))
+    return Grouper(args.host, args.base_url, **kwargs)
+
+
+def _load_members_command(args):
+    grouper = _grouper_from_args(args)
+    checkpoint = Checkpoint(args.checkpoint, args.chunk_size)
+    try:
+        _, failed = load_members(
+            grouper,
+            read_membership_rows(args.path, args.format),
+            chunk_size=args.chunk_size,
+            max_workers=args.workers,
+            checkpoint=checkpoint,
+            progress=None if args.quiet else _report_progress,
+        )
+    finally:
+        checkpoint.close()
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='grouper-ws', description="Grouper Web Services tools")
+    parser.add_argument('--host', required=True, help="Grouper WS host name")
+    parser.add_argument('--base-url', default='/grouper-ws/', help="Grouper WS base path")
+    parser.add_argument('--username', help="Use basic auth; password is read from $GROUPER_PASSWORD")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    subparsers = parser.add_subparsers(dest='command')
+
+    load = subparsers.add_parser('load-members', help="Add memberships from a CSV or NDJSON file")
+    load.add_argument('path', help="File of group, subject and optional source records")
+    load.add_argument('--format', choices=['csv', 'ndjson'], help="Defaults to the file extension")
+    load.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    load.add_argument('--workers', type=int, default=DEFAULT_MAX_WORKERS)
+    load.add_argument('--checkpoint', help="File recording completed chunks, for resuming a load")
+    load.add_argument('-q', '--quiet', action='store_true', help="Do not report progress")
+    load.set_defaults(func=_load_members_command)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    if getattr(args, 'func', None) is None:
+        parser.print_help()
+        return 2
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import gzip
+import io
+import logging
+import threading
+
+
+DEFAULT_COMPRESS_THRESHOLD = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def gzip_bytes(data, level=6):
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def wire_size(http_response):
+    """
+    Return the number of body bytes actually received for a response, or
+    None if it cannot be determined.
+    """
+    raw = getattr(http_response, 'raw', None)
+    if raw is not None and hasattr(raw, 'tell'):
+        try:
+            return raw.tell()
+        except Exception:
+            pass
+    length = http_response.headers.get('Content-Length')
+    if length is not None:
+        return int(length)
+    return None
+
+
+class CompressionStats(object):
+    """
+    Running totals of body sizes before and after compression.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.request_bytes = 0
+        self.request_bytes_sent = 0
+        self.response_bytes = 0
+        self.response_bytes_received = 0
+
+    def record(self, request_bytes, request_bytes_sent, response_bytes, response_bytes_received):
+        with self._lock:
+            self.requests += 1
+            self.request_bytes += request_bytes
+            self.request_bytes_sent += request_bytes_sent
+            self.response_bytes += response_bytes
+            self.response_bytes_received += response_bytes_received
+        logger.debug("Request body {0} -> {1} bytes, response body {2} <- {3} bytes".format(
+            request_bytes, request_bytes_sent, response_bytes, response_bytes_received
+        ))
+
+    @property
+    def bytes_saved(self):
+        return (self.request_bytes - self.request_bytes_sent) + \
+            (self.response_bytes - self.response_bytes_received)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'request_bytes': self.request_bytes,
+                'request_bytes_sent': self.request_bytes_sent,
+                'response_bytes': self.response_bytes,
+                'response_bytes_received': self.response_bytes_received,
+                'bytes_saved': self.bytes_saved,
+            }
@@ -0,0 +1,151 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def current_deadline():
+    """
+    Return the absolute time by which the current thread's calls must
+    finish, or None.
+    """
+    return getattr(_local, 'deadline', None)
+
+
+def remaining():
+    """
+    Return the seconds left before the current deadline, or None.
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return None
+    return deadline - time.time()
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Require every Grouper call made in this block, including retries and
+    further pages, to finish within seconds. Nested deadlines can only
+    shorten the time allowed.
+    """
+    previous = current_deadline()
+    new = time.time() + seconds
+    if previous is not None:
+        new = min(new, previous)
+    _local.deadline = new
+    try:
+        yield new
+    finally:
+        _local.deadline = previous
+
+
+def with_current_deadline(func):
+    """
+    Wrap func so that it runs under the calling thread's deadline, for
+    handing work to other threads.
+    """
+    captured = current_deadline()
+    if captured is None:
+        return func
+
+    def wrapped(*args, **kwargs):
+        previous = current_deadline()
+        _local.deadline = captured
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.deadline = previous
+    return wrapped
+
+
+def request_timeout(timeout):
+    """
+    Combine a client timeout (seconds or a (connect, read) tuple) with the
+    current deadline, raising DeadlineExceeded if it has already passed.
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded("Deadline exceeded before request was sent")
+    if timeout is None:
+        return left
+    if isinstance(timeout, tuple):
+        return tuple(min(t, left) if t is not None else left for t in timeout)
+    return min(timeout, left)
+
+
+class Hedger(object):
+    """
+    Send a second copy of a slow idempotent request.
+
+    Once min_samples latencies have been seen for a key, a call which has
+    not finished within the given percentile of recent latencies is sent
+    again, and whichever copy answers first is used. The slower copy is
+    left to finish in the background.
+    """
+    def __init__(self, percentile=0.95, window=200, min_samples=20, max_workers=16):
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._latencies = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def observe(self, key, latency):
+        with self._lock:
+            samples = self._latencies.get(key)
+            if samples is None:
+                samples = self._latencies[key] = deque(maxlen=self.window)
+            samples.append(latency)
+
+    def delay(self, key):
+        with self._lock:
+            samples = self._latencies.get(key)
+            if samples is None or len(samples) < self.min_samples:
+                return None
+            ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))]
+
+    def call(self, key, func):
+        def timed():
+            started = time.time()
+            result = func()
+            self.observe(key, time.time() - started)
+            return result
+
+        delay = self.delay(key)
+        if delay is None:
+            return timed()
+        timed = with_current_deadline(timed)
+        futures = [self._executor.submit(timed)]
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            logger.debug("Hedging request for {0} after {1:.3f}s".format(key, delay))
+            futures.append(self._executor.submit(timed))
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except Exception as e:
+                    error = e
+        raise error
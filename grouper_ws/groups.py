@@ -114,12 +114,14 @@ def group_from_json_dict(json_dict):
     # Extract wsGroup if present, otherwise assume we have group data
     json_dict = json_dict.get('wsGroup', json_dict)
     group_name = json_dict['name']
+    display_name = json_dict.get('displayExtension', None)
     details = json_dict.get('detail', {})
     uuid = json_dict.get('uuid', None)
     created = details.get('createTime', None)
     modified = details.get('modifyTime', None)
     group = Group(
         group_name,
+        display_name=display_name,
         uuid=uuid,
         created_time=created,
         modified_time=modified
@@ -136,6 +138,7 @@ def group_from_json_dict(json_dict):
             left_group,
             right_group,
             composite_type, 
+            display_name=display_name,
             uuid=uuid,
             created_time=created,
             modified_time=modified
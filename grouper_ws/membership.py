@@ -0,0 +1,151 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import threading
+import time
+
+from .api import member_to_subject_lookup, str_to_group
+
+
+logger = logging.getLogger(__name__)
+
+
+class _MemberSet(object):
+    def __init__(self, members, loaded):
+        # (subject_id, source_id) pairs, plus bare IDs for source-less checks
+        self.members = frozenset(members)
+        self.subject_ids = frozenset(subject_id for subject_id, _ in members)
+        self.loaded = loaded
+
+    def __contains__(self, lookup):
+        subject_id, source_id = lookup
+        if source_id is None:
+            return subject_id in self.subject_ids
+        return (subject_id, source_id) in self.members
+
+
+def fetch_member_set(grouper, group, page_size=1000):
+    """
+    Return a set of (subject_id, source_id) for every member of group,
+    fetched in pages of page_size. Raises if any page fails, so a partial
+    set is never returned.
+    """
+    members = set()
+    page = 1
+    while True:
+        response = grouper.get_members(
+            [group], subject_attributes=[], details=False,
+            page_size=page_size, page=page
+        )
+        results = response['WsGetMembersResults']
+        group_results = results.get('results', [])
+        metadata = results.get('resultMetadata', {})
+        if group_results:
+            metadata = group_results[0].get('resultMetadata', metadata)
+        if metadata.get('success') != 'T' or not group_results:
+            raise Exception("fetch_member_set(): Page {0} of {1} failed: {2}".format(
+                page, group, metadata.get('resultCode')
+            ))
+        subjects = group_results[0].get('wsSubjects', [])
+        for subject in subjects:
+            members.add((subject['id'], subject.get('sourceId')))
+        if len(subjects) < page_size:
+            return members
+        page += 1
+
+
+class MembershipChecker(object):
+    """
+    Answer membership checks from local member sets for a fixed list of hot
+    groups, refreshed in the background.
+
+    Checks against other groups, or against hot groups whose data is older
+    than max_staleness seconds, fall back to Grouper.has_members.
+    """
+    def __init__(self, grouper, hot_groups, refresh_interval=300,
+                 max_staleness=900, page_size=1000):
+        self.grouper = grouper
+        self.hot_groups = [str_to_group(group).group_name for group in hot_groups]
+        self.refresh_interval = refresh_interval
+        self.max_staleness = max_staleness
+        self.page_size = page_size
+        self._sets = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self, group=None):
+        """
+        Reload the member set of group, or of every hot group.
+        """
+        groups = self.hot_groups if group is None else [str_to_group(group).group_name]
+        for name in groups:
+            loaded = time.time()
+            try:
+                members = fetch_member_set(self.grouper, name, self.page_size)
+            except Exception as e:
+                logger.warning("Refreshing members of {0} failed: {1}".format(name, e))
+                continue
+            # Replace the whole set at once so readers never see a partial load
+            self._sets[name] = _MemberSet(members, loaded)
+            logger.debug("Loaded {0} members of {1}".format(len(members), name))
+
+    def start(self, wait=True):
+        """
+        Start the background refresh thread. With wait, the first load of
+        every hot group is done before returning.
+        """
+        if wait:
+            self.refresh()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='MembershipChecker')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.refresh_interval):
+            self.refresh()
+
+    def _fresh_set(self, group):
+        member_set = self._sets.get(group)
+        if member_set is None or time.time() - member_set.loaded > self.max_staleness:
+            return None
+        return member_set
+
+    def is_member(self, group, subject):
+        return self.are_members(group, [subject])[0]
+
+    def are_members(self, group, subjects):
+        """
+        Return a list of booleans, one per subject, saying whether each is a
+        member of group. Subjects which cannot be answered locally are checked
+        with a single has_members call.
+        """
+        group = str_to_group(group).group_name
+        member_set = self._fresh_set(group)
+        answers = [None] * len(subjects)
+        remote = []
+        for i, subject in enumerate(subjects):
+            lookup = member_to_subject_lookup(subject)
+            if member_set is not None and 'subjectId' in lookup:
+                answers[i] = (lookup['subjectId'], lookup.get('subjectSourceId')) in member_set
+            else:
+                remote.append(i)
+
+        metrics = getattr(self.grouper, 'metrics', None)
+        if metrics is not None and len(remote) < len(subjects):
+            metrics.record_cache_hit('membership', len(subjects) - len(remote))
+
+        if remote:
+            response = self.grouper.has_members(group, [subjects[i] for i in remote])
+            results = response['WsHasMemberResults'].get('results', [])
+            for i, result in zip(remote, results):
+                answers[i] = result['resultMetadata']['resultCode'] == 'IS_MEMBER'
+        return answers
@@ -0,0 +1,164 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import bisect
+import threading
+
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def request_endpoint(data):
+    """
+    Name a WS call by its request type, e.g. 'WsRestGetMembersRequest'.
+    """
+    if len(data) == 1:
+        return next(iter(data))
+    return 'unknown'
+
+
+def result_code(response):
+    """
+    Return the top-level resultCode of a WS response, if there is one.
+    """
+    for results in response.values():
+        if isinstance(results, dict) and 'resultMetadata' in results:
+            return results['resultMetadata'].get('resultCode')
+    return None
+
+
+class _EndpointMetrics(object):
+    def __init__(self, bucket_count):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.latency_sum = 0.0
+        self.latency_buckets = [0] * (bucket_count + 1)
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.result_codes = {}
+
+
+def _labels(**labels):
+    return ','.join(
+        '{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in sorted(labels.items())
+    )
+
+
+class MetricsRegistry(object):
+    """
+    Thread-safe per-endpoint request metrics.
+
+    Pass an instance as Grouper(metrics=...) to have every WS call recorded.
+    Clients without a registry skip metrics collection entirely.
+    """
+    def __init__(self, latency_buckets=DEFAULT_LATENCY_BUCKETS, prefix='grouper_ws'):
+        self.latency_buckets = tuple(latency_buckets)
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._cache_hits = {}
+
+    def _endpoint(self, endpoint):
+        metrics = self._endpoints.get(endpoint)
+        if metrics is None:
+            metrics = self._endpoints[endpoint] = _EndpointMetrics(len(self.latency_buckets))
+        return metrics
+
+    def record_request(self, endpoint, latency, request_bytes=0, response_bytes=0,
+                       code=None, failed=False):
+        bucket = bisect.bisect_left(self.latency_buckets, latency)
+        with self._lock:
+            metrics = self._endpoint(endpoint)
+            metrics.count += 1
+            metrics.latency_sum += latency
+            metrics.latency_buckets[bucket] += 1
+            metrics.request_bytes += request_bytes
+            metrics.response_bytes += response_bytes
+            if failed:
+                metrics.errors += 1
+            if code is not None:
+                metrics.result_codes[code] = metrics.result_codes.get(code, 0) + 1
+
+    def record_retry(self, endpoint, count=1):
+        with self._lock:
+            self._endpoint(endpoint).retries += count
+
+    def record_cache_hit(self, cache, count=1):
+        with self._lock:
+            self._cache_hits[cache] = self._cache_hits.get(cache, 0) + count
+
+    def snapshot(self):
+        """
+        Return a plain dict copy of all metrics.
+        """
+        with self._lock:
+            endpoints = {}
+            for name, metrics in self._endpoints.items():
+                endpoints[name] = {
+                    'count': metrics.count,
+                    'errors': metrics.errors,
+                    'retries': metrics.retries,
+                    'latency_sum': metrics.latency_sum,
+                    'latency_buckets': list(zip(
+                        self.latency_buckets + (float('inf'),), metrics.latency_buckets
+                    )),
+                    'request_bytes': metrics.request_bytes,
+                    'response_bytes': metrics.response_bytes,
+                    'result_codes': dict(metrics.result_codes),
+                }
+            return {
+                'endpoints': endpoints,
+                'cache_hits': dict(self._cache_hits),
+            }
+
+    def to_prometheus(self):
+        """
+        Render all metrics in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        p = self.prefix
+        lines = []
+
+        def counter(name, help_text, values):
+            lines.append('# HELP {0}_{1} {2}'.format(p, name, help_text))
+            lines.append('# TYPE {0}_{1} counter'.format(p, name))
+            for labels, value in values:
+                lines.append('{0}_{1}{{{2}}} {3}'.format(p, name, labels, value))
+
+        endpoints = sorted(snapshot['endpoints'].items())
+        counter('requests_total', "WS requests made.",
+                [(_labels(endpoint=e), m['count']) for e, m in endpoints])
+        counter('errors_total', "WS requests which raised or returned a 5xx status.",
+                [(_labels(endpoint=e), m['errors']) for e, m in endpoints])
+        counter('retries_total', "WS requests retried.",
+                [(_labels(endpoint=e), m['retries']) for e, m in endpoints])
+        counter('request_bytes_total', "Request body bytes sent.",
+                [(_labels(endpoint=e), m['request_bytes']) for e, m in endpoints])
+        counter('response_bytes_total', "Response body bytes received.",
+                [(_labels(endpoint=e), m['response_bytes']) for e, m in endpoints])
+        counter('result_codes_total', "WS result codes returned.",
+                [(_labels(endpoint=e, code=c), n)
+                 for e, m in endpoints for c, n in sorted(m['result_codes'].items())])
+        counter('cache_hits_total', "Requests answered without calling Grouper.",
+                [(_labels(cache=c), n) for c, n in sorted(snapshot['cache_hits'].items())])
+
+        lines.append('# HELP {0}_request_latency_seconds WS request latency.'.format(p))
+        lines.append('# TYPE {0}_request_latency_seconds histogram'.format(p))
+        for e, m in endpoints:
+            cumulative = 0
+            for bound, count in m['latency_buckets']:
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{0}_request_latency_seconds_bucket{{{1}}} {2}'.format(
+                    p, _labels(endpoint=e, le=le), cumulative
+                ))
+            lines.append('{0}_request_latency_seconds_sum{{{1}}} {2}'.format(
+                p, _labels(endpoint=e), m['latency_sum']
+            ))
+            lines.append('{0}_request_latency_seconds_count{{{1}}} {2}'.format(
+                p, _labels(endpoint=e), m['count']
+            ))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,127 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import multiprocessing
+import time
+
+from . import queries
+from .bulk import chunked
+
+
+logger = logging.getLogger(__name__)
+
+# Per-process client, set up by _init_worker()
+_worker_grouper = None
+
+
+def find_group_names(grouper, root_stem):
+    """
+    Return the names of every group below root_stem.
+    """
+    response = grouper.find_groups(queries.FindByStemName(root_stem, recursive=True))
+    results = response['WsFindGroupsResults'].get('groupResults', [])
+    return sorted(g['name'] for g in results)
+
+
+def _init_worker(grouper_factory, limiter):
+    global _worker_grouper
+    _worker_grouper = grouper_factory()
+    if limiter is not None:
+        _worker_grouper.limiter = limiter
+
+
+def _run_shard(args):
+    task, shard = args
+    outcomes = []
+    for group_name in shard:
+        try:
+            outcomes.append((group_name, task(_worker_grouper, group_name), None))
+        except Exception as e:
+            # Exceptions may not pickle, so only their description is returned
+            logger.warning("Task for {0} failed: {1}".format(group_name, e))
+            outcomes.append((group_name, None, '{0}: {1}'.format(type(e).__name__, e)))
+    return outcomes
+
+
+def run_sharded(grouper_factory, task, group_names, processes=None,
+                shard_size=50, limiter=None):
+    """
+    Run task(grouper, group_name) for every group across a process pool,
+    yielding (group_name, result, error) as each shard finishes.
+
+    grouper_factory is called once in every worker to build that process's
+    own Grouper. A shared limiter (throttle.AdaptiveLimiter(shared=True)) is
+    installed on every worker's client so all processes respect one
+    host-wide rate and concurrency limit. task, grouper_factory and results
+    must be picklable; errors are returned as strings.
+    """
+    shards = [(task, shard) for shard in chunked(group_names, shard_size)]
+    pool = multiprocessing.Pool(
+        processes=processes, initializer=_init_worker,
+        initargs=(grouper_factory, limiter)
+    )
+    try:
+        for outcomes in pool.imap_unordered(_run_shard, shards):
+            for outcome in outcomes:
+                yield outcome
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+class SyncReport(object):
+    """
+    Aggregated outcome of run_sharded(), with results kept per group.
+    """
+    def __init__(self, total):
+        self.total = total
+        self.results = {}
+        self.errors = {}
+        self.started = time.time()
+
+    @property
+    def done(self):
+        return len(self.results) + len(self.errors)
+
+    def add(self, group_name, result, error):
+        if error is not None:
+            self.errors[group_name] = error
+        else:
+            self.results[group_name] = result
+
+    def __str__(self):
+        elapsed = time.time() - self.started
+        return "{0}/{1} groups, {2} errors, {3:.1f} groups/s".format(
+            self.done, self.total, len(self.errors),
+            self.done / elapsed if elapsed > 0 else 0.0
+        )
+
+
+def sync_subtree(grouper, grouper_factory, root_stem, task, processes=None,
+                 shard_size=50, limiter=None, progress=None, progress_interval=5.0):
+    """
+    Find every group below root_stem with grouper and run task on each one
+    in a process pool (see run_sharded()), calling progress(report)
+    periodically. Returns the final SyncReport.
+    """
+    group_names = find_group_names(grouper, root_stem)
+    report = SyncReport(len(group_names))
+    last_report = time.time()
+    outcomes = run_sharded(
+        grouper_factory, task, group_names, processes=processes,
+        shard_size=shard_size, limiter=limiter
+    )
+    for group_name, result, error in outcomes:
+        report.add(group_name, result, error)
+        now = time.time()
+        if progress is not None and now - last_report >= progress_interval:
+            last_report = now
+            progress(report)
+    if progress is not None:
+        progress(report)
+    return report
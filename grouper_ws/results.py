@@ -0,0 +1,150 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import time
+
+from .deadlines import remaining, DeadlineExceeded
+from .transport import CONNECTION_ERRORS
+
+
+# Per-item result codes which may succeed if the item is simply resent
+TRANSIENT_RESULT_CODES = set([
+    'EXCEPTION',
+    'TRANSACTION_ROLLED_BACK',
+])
+
+# Exceptions from sending a request which may not recur if it is resent
+TRANSIENT_ERRORS = CONNECTION_ERRORS + (DeadlineExceeded,)
+
+# Keys under which bulk responses list their per-item results
+ITEM_RESULT_KEYS = ['results', 'wsAttributeAssignResults']
+
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 0.5
+
+logger = logging.getLogger(__name__)
+
+
+class ItemResult(object):
+    def __init__(self, item, success, result_code=None, message=None, transient=False, result=None):
+        self.item = item
+        self.success = success
+        self.result_code = result_code
+        self.message = message
+        self.transient = transient
+        self.result = result
+
+    def __str__(self):
+        return "ItemResult: %s (%s)" % (self.item, self.result_code)
+
+
+class BulkResult(object):
+    """
+    Outcome of a bulk WS call, one ItemResult per item sent, in order.
+    """
+    def __init__(self, items, responses, attempts=1):
+        self.items = items
+        self.responses = responses
+        self.attempts = attempts
+
+    @property
+    def success(self):
+        return all(item.success for item in self.items)
+
+    def succeeded(self):
+        return [item for item in self.items if item.success]
+
+    def failed(self):
+        return [item for item in self.items if not item.success]
+
+    def transient_failures(self):
+        return [item for item in self.items if not item.success and item.transient]
+
+    def permanent_failures(self):
+        return [item for item in self.items if not item.success and not item.transient]
+
+
+def _metadata(result):
+    metadata = result.get('resultMetadata', {})
+    return metadata.get('success'), metadata.get('resultCode'), metadata.get('resultMessage')
+
+
+def parse_bulk_response(response, items):
+    """
+    Pair each of items with its per-item result in a bulk WS response.
+
+    Items without a per-item result take the outcome of the response as a
+    whole.
+    """
+    results = {}
+    for value in response.values():
+        if isinstance(value, dict):
+            results = value
+            break
+    top_success, top_code, top_message = _metadata(results)
+    item_results = []
+    for key in ITEM_RESULT_KEYS:
+        if key in results:
+            item_results = results[key]
+            break
+
+    parsed = []
+    for i, item in enumerate(items):
+        result = item_results[i] if i < len(item_results) else {}
+        success, code, message = _metadata(result)
+        if success is None:
+            success, code, message = top_success, top_code, top_message
+        parsed.append(ItemResult(
+            item, success == 'T', code, message,
+            transient=code in TRANSIENT_RESULT_CODES, result=result
+        ))
+    return parsed
+
+
+def call_with_retry(func, items, max_retries=DEFAULT_MAX_RETRIES,
+                    backoff=DEFAULT_RETRY_BACKOFF, metrics=None, endpoint=None):
+    """
+    Call func(items) for a bulk WS operation and resend only the items which
+    failed transiently, up to max_retries more times with exponential
+    backoff, stopping early if the current deadline would pass. Connection
+    errors, timeouts and DeadlineExceeded raised by func count as transient
+    failures of every item sent in that call; other exceptions are raised.
+
+    Returns a BulkResult covering all items.
+    """
+    items = list(items)
+    outcomes = [None] * len(items)
+    responses = []
+    pending = list(range(len(items)))
+    attempt = 0
+    while True:
+        batch = [items[i] for i in pending]
+        try:
+            response = func(batch)
+            responses.append(response)
+            parsed = parse_bulk_response(response, batch)
+        except TRANSIENT_ERRORS as e:
+            logger.warning("Bulk call of {0} items failed: {1}".format(len(batch), e))
+            code = 'DEADLINE_EXCEEDED' if isinstance(e, DeadlineExceeded) else 'EXCEPTION'
+            parsed = [
+                ItemResult(item, False, code, str(e), transient=True)
+                for item in batch
+            ]
+        for i, result in zip(pending, parsed):
+            outcomes[i] = result
+        pending = [i for i in pending if not outcomes[i].success and outcomes[i].transient]
+        if not pending or attempt >= max_retries:
+            break
+        delay = backoff * 2 ** attempt
+        left = remaining()
+        if left is not None and left <= delay:
+            logger.debug("Not retrying {0} items: deadline too close".format(len(pending)))
+            break
+        attempt += 1
+        logger.debug("Retrying {0} transiently failed items (attempt {1})".format(len(pending), attempt))
+        if metrics is not None:
+            metrics.record_retry(endpoint or 'bulk', len(pending))
+        time.sleep(delay)
+    return BulkResult(outcomes, responses, attempt + 1)
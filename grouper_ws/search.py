@@ -0,0 +1,149 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+from .api import DEFAULT_SUBJECT_ATTRIBUTES
+from .subjects import subject_from_json_dict
+
+
+logger = logging.getLogger(__name__)
+
+
+def subjects_from_response(response):
+    results = response['WsGetSubjectsResults']
+    attribute_names = results.get('subjectAttributeNames', [])
+    return [
+        subject_from_json_dict(subject, attribute_names)
+        for subject in results.get('wsSubjects', [])
+        if subject.get('success', 'T') == 'T'
+    ]
+
+
+def _matches(subject, text):
+    # Like the server, every whitespace-separated token must match somewhere
+    values = [subject.subject_id, subject.name] + list(subject.attributes.values())
+    values = [value.lower() for value in values if value is not None]
+    return all(
+        any(token in value for value in values)
+        for token in text.lower().split()
+    )
+
+
+class SubjectSearch(object):
+    """
+    Free-text subject search for type-ahead pickers.
+
+    search() yields Subjects lazily, fetching page_size results per request,
+    so callers can stop as soon as they have enough. Completed pages are
+    kept in a small LRU cache for ttl seconds.
+
+    With narrow_locally, once every result for a search string has been
+    read (ending on a short page), a longer string starting with it (the
+    next keystroke) is answered by filtering those results locally, without
+    asking Grouper again. A subject matches if each word of the search
+    string appears in its ID, name or one of subject_attributes. Grouper
+    may also match source attributes which were not requested, so local
+    narrowing can drop subjects the server would return; it is off by
+    default.
+    """
+    def __init__(self, grouper, subject_attributes=DEFAULT_SUBJECT_ATTRIBUTES,
+                 source_ids=None, page_size=50, cache_size=256, ttl=60,
+                 narrow_locally=False):
+        self.grouper = grouper
+        self.subject_attributes = subject_attributes
+        self.source_ids = source_ids
+        self.page_size = page_size
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.narrow_locally = narrow_locally
+        self._lock = threading.Lock()
+        self._pages = OrderedDict()
+        self._complete = OrderedDict()
+
+    def _cache_get(self, cache, key):
+        with self._lock:
+            entry = cache.get(key)
+            if entry is None:
+                return None
+            stored, value = entry
+            if time.time() - stored > self.ttl:
+                del cache[key]
+                return None
+            cache.pop(key)
+            cache[key] = entry
+            return value
+
+    def _cache_put(self, cache, key, value):
+        with self._lock:
+            cache.pop(key, None)
+            cache[key] = (time.time(), value)
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+
+    def _page(self, text, page):
+        subjects = self._cache_get(self._pages, (text, page))
+        metrics = getattr(self.grouper, 'metrics', None)
+        if subjects is not None:
+            if metrics is not None:
+                metrics.record_cache_hit('subject_search')
+            return subjects
+        response = self.grouper.search_subjects(
+            text, subject_attributes=self.subject_attributes,
+            source_ids=self.source_ids, page_size=self.page_size, page=page
+        )
+        subjects = subjects_from_response(response)
+        self._cache_put(self._pages, (text, page), subjects)
+        return subjects
+
+    def _narrowed(self, text):
+        for length in range(len(text) - 1, 0, -1):
+            subjects = self._cache_get(self._complete, text[:length])
+            if subjects is not None:
+                return [subject for subject in subjects if _matches(subject, text)]
+        return None
+
+    def search(self, text, limit=None):
+        """
+        Yield Subjects matching text, at most limit of them.
+        """
+        count = 0
+        if self.narrow_locally:
+            subjects = self._cache_get(self._complete, text)
+            if subjects is None:
+                subjects = self._narrowed(text)
+            if subjects is not None:
+                for subject in subjects[:limit]:
+                    yield subject
+                return
+
+        found = []
+        seen = set()
+        page = 1
+        while True:
+            subjects = self._page(text, page)
+            new = [
+                subject for subject in subjects
+                if (subject.subject_id, subject.source_id) not in seen
+            ]
+            if subjects and not new:
+                # A server which ignores paging repeats the same page, so
+                # what has been read cannot be known to be complete
+                return
+            for subject in new:
+                seen.add((subject.subject_id, subject.source_id))
+                found.append(subject)
+                yield subject
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+            # A short page is the last; an oversized one means the server
+            # does not page subject searches and has returned everything
+            if len(subjects) != self.page_size:
+                break
+            page += 1
+        self._cache_put(self._complete, text, found)
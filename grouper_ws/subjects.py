@@ -14,12 +14,14 @@ except ImportError: # Py2
 
 class Subject(object):
     def __init__(self, subject_id=None, source_id=None,
-                 subject_identifier=None):
+                 subject_identifier=None, name=None, attributes=None):
         if subject_id is None and subject_identifier is None:
             raise Exception("No means of identifying subject")
         self.subject_id = subject_id
         self.subject_identifier = subject_identifier
         self.source_id = source_id
+        self.name = name
+        self.attributes = attributes or {}
 
     def to_json_dict(self, include_details=True):
         return {
@@ -51,3 +53,15 @@ class Subject(object):
         source_id = json_dict['subjectSourceId']
 
         return Subject(subject_id=subject_id, source_id=source_id)
+
+
+def subject_from_json_dict(json_dict, attribute_names=()):
+    # Build a subject from a wsSubject result, mapping attributeValues onto
+    # the subjectAttributeNames of the response
+    values = json_dict.get('attributeValues', [])
+    return Subject(
+        subject_id=json_dict['id'],
+        source_id=json_dict.get('sourceId'),
+        name=json_dict.get('name'),
+        attributes=dict(zip(attribute_names, values)),
+    )
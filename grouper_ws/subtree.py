@@ -0,0 +1,219 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+
+from . import stem_queries
+from .audit import find_subtree
+from .bulk import add_members_checked, chunked, delete_groups_checked, \
+    delete_stems_checked, plan_group_levels, run_chunks_checked, run_concurrently, \
+    save_groups_ordered, save_stems_checked, DEFAULT_CHUNK_SIZE, DEFAULT_MAX_WORKERS
+from .groups import CompositeGroup, Group, group_from_json_dict
+from .stems import Stem, stem_from_json_dict
+from .subjects import Subject
+
+
+logger = logging.getLogger(__name__)
+
+
+def lookup_group_details(grouper, group_names, chunk_size=DEFAULT_CHUNK_SIZE,
+                         max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Return Group/CompositeGroup objects for group_names, looked up in
+    concurrent chunks.
+    """
+    groups = []
+    outcomes = run_concurrently(grouper.lookup_groups, chunked(group_names, chunk_size), max_workers)
+    for chunk, response, error in outcomes:
+        if error is not None:
+            raise error
+        for result in response['WsFindGroupsResults'].get('groupResults', []):
+            groups.append(group_from_json_dict(result))
+    return groups
+
+
+def stem_depth(stem_name):
+    return stem_name.count(':')
+
+
+def plan_subtree_deletion(grouper, stem, chunk_size=DEFAULT_CHUNK_SIZE,
+                          max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Return the ordered steps needed to delete stem and everything below it,
+    as a list of ('groups' or 'stems', [names]) tuples. The names within a
+    step can be deleted concurrently.
+
+    Composite groups are deleted before the groups they are built from, and
+    stems are deleted deepest first once all groups are gone.
+    """
+    stem_names, group_names = find_subtree(grouper, stem)
+    groups = lookup_group_details(grouper, group_names, chunk_size, max_workers)
+    steps = []
+    for level in reversed(plan_group_levels(groups)):
+        steps.append(('groups', [group.group_name for group in level]))
+    by_depth = {}
+    for name in stem_names:
+        by_depth.setdefault(stem_depth(name), []).append(name)
+    for depth in sorted(by_depth, reverse=True):
+        steps.append(('stems', sorted(by_depth[depth])))
+    return steps
+
+
+def delete_subtree(grouper, stem, dry_run=False, chunk_size=DEFAULT_CHUNK_SIZE,
+                   max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Delete stem with every group and stem below it.
+
+    Each step of plan_subtree_deletion() is run as concurrent chunked
+    delete_groups/delete_stems calls; a step which leaves any failures stops
+    the deletion with an exception. With dry_run, the plan is returned and
+    nothing is deleted. Otherwise the list of BulkResults is returned.
+    """
+    steps = plan_subtree_deletion(grouper, stem, chunk_size, max_workers)
+    if dry_run:
+        return steps
+
+    results = []
+    for kind, names in steps:
+        logger.debug("Deleting {0} {1}".format(len(names), kind))
+        if kind == 'groups':
+            delete = lambda chunk: delete_groups_checked(grouper, chunk)
+        else:
+            delete = lambda chunk: delete_stems_checked(grouper, chunk)
+        results.extend(run_chunks_checked(
+            delete, chunked(names, chunk_size), max_workers,
+            error="delete_subtree(): Failed to delete {0}".format(kind)
+        ))
+    return results
+
+
+def rename_in_subtree(name, src, dst):
+    """
+    Return name moved from below src to below dst, or name unchanged if it
+    is outside src.
+    """
+    if name == src:
+        return dst
+    if name.startswith(src + ':'):
+        return dst + name[len(src):]
+    return name
+
+
+def _immediate_members(grouper, group_name):
+    response = grouper.get_group_memberships(
+        group_name, member_filter='Immediate', subject_attributes=[], details=False
+    )
+    results = response['WsGetMembershipsResults']
+    return [
+        (membership['subjectId'], membership['subjectSourceId'])
+        for membership in results.get('wsMemberships', [])
+    ]
+
+
+def snapshot_subtree(grouper, stem, chunk_size=DEFAULT_CHUNK_SIZE,
+                     max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Read stem and everything below it with bulk calls.
+
+    Returns (stems, groups, members): the Stems below stem, the
+    Group/CompositeGroup objects in it, and a dict of group name to the
+    (subject ID, source ID) pairs of its immediate members. Members are
+    read concurrently, one group per call; composite groups have none.
+    """
+    response = grouper.find_stems(
+        stem_queries.FindByParentStemName(stem, stem_name=None, recursive=True)
+    )
+    stems = [
+        stem_from_json_dict(result)
+        for result in response['WsFindStemsResults'].get('stemResults', [])
+        if result['name'] != stem
+    ]
+    _, group_names = find_subtree(grouper, stem)
+    groups = lookup_group_details(grouper, group_names, chunk_size, max_workers)
+
+    plain = [group.group_name for group in groups if not group.is_composite()]
+    members = {}
+    for group_name, pairs, error in run_concurrently(
+            lambda name: _immediate_members(grouper, name), plain, max_workers):
+        if error is not None:
+            raise error
+        members[group_name] = pairs
+    return stems, groups, members
+
+
+def _renamed_group(group, src, dst):
+    group_name = rename_in_subtree(group.group_name, src, dst)
+    if not group.is_composite():
+        return Group(group_name, display_name=group.display_name)
+    return CompositeGroup(
+        group_name,
+        rename_in_subtree(group.left_group.group_name, src, dst),
+        rename_in_subtree(group.right_group.group_name, src, dst),
+        group.composite_type,
+        display_name=group.display_name,
+    )
+
+
+def clone_subtree(grouper, src, dst, chunk_size=DEFAULT_CHUNK_SIZE,
+                  max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Copy stem src, with the stems, groups and immediate memberships below
+    it, to a new stem dst.
+
+    The source is read with snapshot_subtree(). Stems are then saved level
+    by level, groups in composite dependency order with save_groups_ordered(),
+    and memberships in concurrent chunks. Composite factors and group
+    members inside src are pointed at their copies below dst; anything
+    outside src is referenced unchanged. Privileges and attribute
+    assignments are not copied.
+
+    Any failure stops the clone with an exception, leaving what has been
+    created so far in place; delete_subtree(grouper, dst) removes it.
+    Returns the number of memberships added.
+    """
+    stems, groups, members = snapshot_subtree(grouper, src, chunk_size, max_workers)
+
+    by_depth = {stem_depth(dst): [Stem(dst)]}
+    for stem in stems:
+        new_name = rename_in_subtree(stem.stem_name, src, dst)
+        by_depth.setdefault(stem_depth(new_name), []).append(
+            Stem(new_name, display_name=stem.display_name)
+        )
+    for depth in sorted(by_depth):
+        run_chunks_checked(
+            lambda chunk: save_stems_checked(grouper, chunk),
+            chunked(by_depth[depth], chunk_size), max_workers,
+            describe=lambda chunk, stem: stem.stem_name,
+            error="clone_subtree(): Failed to save stems"
+        )
+
+    logger.debug("Saving {0} groups below {1}".format(len(groups), dst))
+    save_groups_ordered(
+        grouper, [_renamed_group(group, src, dst) for group in groups],
+        chunk_size, max_workers
+    )
+
+    # Groups which are members of other groups are looked up by their uuid
+    copies = dict(
+        (group.uuid, rename_in_subtree(group.group_name, src, dst))
+        for group in groups if group.uuid is not None
+    )
+    chunks = []
+    for group_name in sorted(members):
+        new_members = []
+        for subject_id, source_id in members[group_name]:
+            if source_id == 'g:gsa' and subject_id in copies:
+                new_members.append(Subject(source_id=source_id, subject_identifier=copies[subject_id]))
+            else:
+                new_members.append((subject_id, source_id))
+        new_name = rename_in_subtree(group_name, src, dst)
+        chunks.extend((new_name, chunk) for chunk in chunked(new_members, chunk_size))
+
+    results = run_chunks_checked(
+        lambda chunk: add_members_checked(grouper, chunk[0], chunk[1]),
+        chunks, max_workers,
+        describe=lambda chunk, member: (chunk[0], str(member)),
+        error="clone_subtree(): Failed to add members"
+    )
+    return sum(len(result.succeeded()) for result in results)
@@ -0,0 +1,192 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from array import array
+import csv
+import io
+
+import six
+
+from .api import member_to_subject_lookup, str_to_group, DEFAULT_SUBJECT_ATTRIBUTES
+
+
+class MemberTable(object):
+    """
+    Column-oriented store of group members.
+
+    Subject IDs and attribute values are kept in parallel lists, and source
+    IDs are dictionary-encoded into a compact integer array. Set operations
+    work on (subject_id, source_id) keys and return new tables.
+    """
+    def __init__(self, attribute_names=()):
+        self.attribute_names = list(attribute_names)
+        self.subject_ids = []
+        self.source_codes = array('I')
+        self.sources = []
+        self.attributes = [[] for _ in self.attribute_names]
+        self._source_codes = {}
+        self._index = None
+        self._ids = None
+
+    def _encode_source(self, source_id):
+        code = self._source_codes.get(source_id)
+        if code is None:
+            code = self._source_codes[source_id] = len(self.sources)
+            self.sources.append(source_id)
+        return code
+
+    def append(self, subject_id, source_id=None, attribute_values=()):
+        self.subject_ids.append(subject_id)
+        self.source_codes.append(self._encode_source(source_id))
+        values = list(attribute_values)
+        for i, column in enumerate(self.attributes):
+            column.append(values[i] if i < len(values) else None)
+        self._index = None
+
+    def __len__(self):
+        return len(self.subject_ids)
+
+    def source_id(self, row):
+        return self.sources[self.source_codes[row]]
+
+    def keys(self):
+        """
+        Iterate over (subject_id, source_id) for every row.
+        """
+        sources = self.sources
+        return six.moves.zip(self.subject_ids, (sources[code] for code in self.source_codes))
+
+    def _key_index(self):
+        if self._index is None:
+            self._index = {}
+            for row, key in enumerate(self.keys()):
+                self._index.setdefault(key, row)
+            self._ids = frozenset(self.subject_ids)
+        return self._index
+
+    def __contains__(self, member):
+        lookup = member_to_subject_lookup(member)
+        index = self._key_index()
+        if 'subjectSourceId' not in lookup:
+            return lookup.get('subjectId') in self._ids
+        return (lookup.get('subjectId'), lookup['subjectSourceId']) in index
+
+    def rows(self):
+        """
+        Iterate over rows as (subject_id, source_id, [attribute values]).
+        """
+        for row, (subject_id, source_id) in enumerate(self.keys()):
+            yield subject_id, source_id, [column[row] for column in self.attributes]
+
+    def _select(self, rows):
+        table = MemberTable(self.attribute_names)
+        for row in rows:
+            table.append(
+                self.subject_ids[row], self.source_id(row),
+                [column[row] for column in self.attributes]
+            )
+        return table
+
+    def union(self, other):
+        """
+        Rows of this table, plus rows of other whose keys are not in this one.
+        Attribute columns follow this table.
+        """
+        index = self._key_index()
+        table = self._select(range(len(self)))
+        for subject_id, source_id, values in other.rows():
+            if (subject_id, source_id) not in index:
+                by_name = dict(zip(other.attribute_names, values))
+                table.append(subject_id, source_id, [by_name.get(name) for name in self.attribute_names])
+        return table
+
+    def difference(self, other):
+        index = other._key_index()
+        return self._select(row for row, key in enumerate(self.keys()) if key not in index)
+
+    def intersection(self, other):
+        index = other._key_index()
+        return self._select(row for row, key in enumerate(self.keys()) if key in index)
+
+    __or__ = union
+    __sub__ = difference
+    __and__ = intersection
+
+    def to_csv(self, f):
+        """
+        Write the table to a path or text file object, one row at a time.
+        """
+        if isinstance(f, six.string_types):
+            with io.open(f, 'w', encoding='utf-8', newline='') as out:
+                return self.to_csv(out)
+        writer = csv.writer(f)
+        writer.writerow(['subject_id', 'source_id'] + self.attribute_names)
+        for subject_id, source_id, values in self.rows():
+            writer.writerow([subject_id, source_id] + values)
+
+
+def member_tables_from_response(response):
+    """
+    Convert a get_members() response into a dict of group name to MemberTable.
+    """
+    results = response['WsGetMembersResults']
+    attribute_names = results.get('subjectAttributeNames', [])
+    tables = {}
+    for result in results.get('results', []):
+        table = tables.setdefault(result['wsGroup']['name'], MemberTable(attribute_names))
+        for subject in result.get('wsSubjects', []):
+            table.append(subject['id'], subject.get('sourceId'), subject.get('attributeValues', []))
+    return tables
+
+
+def get_member_tables(grouper, groups, subject_attributes=DEFAULT_SUBJECT_ATTRIBUTES,
+                      page_size=None):
+    """
+    Fetch the members of groups as MemberTables, paging through each group
+    page_size members at a time if page_size is given.
+    """
+    groups = [str_to_group(group).group_name for group in groups]
+    tables = {}
+    page = 1
+    while groups:
+        response = grouper.get_members(
+            groups, subject_attributes=subject_attributes,
+            page_size=page_size, page=page
+        )
+        full = []
+        for name, table in member_tables_from_response(response).items():
+            if name not in tables:
+                tables[name] = table
+            else:
+                for subject_id, source_id, values in table.rows():
+                    tables[name].append(subject_id, source_id, values)
+            if page_size is not None and len(table) >= page_size:
+                full.append(name)
+        groups = full
+        page += 1
+    return tables
+
+
+def get_membership_table(grouper, group, member_filter='All',
+                         subject_attributes=DEFAULT_SUBJECT_ATTRIBUTES):
+    """
+    Fetch the memberships of group as a MemberTable.
+    """
+    response = grouper.get_group_memberships(
+        group, member_filter=member_filter, subject_attributes=subject_attributes
+    )
+    results = response['WsGetMembershipsResults']
+    attribute_names = results.get('subjectAttributeNames', [])
+    subjects = {}
+    for subject in results.get('wsSubjects', []):
+        subjects[(subject['id'], subject.get('sourceId'))] = subject.get('attributeValues', [])
+    table = MemberTable(attribute_names)
+    seen = set()
+    for membership in results.get('wsMemberships', []):
+        key = (membership['subjectId'], membership.get('subjectSourceId'))
+        if key in seen:
+            continue
+        seen.add(key)
+        table.append(key[0], key[1], subjects.get(key, []))
+    return table
@@ -0,0 +1,94 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import logging
+import multiprocessing
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+# Offsets into the limiter state array
+_LIMIT = 0
+_IN_FLIGHT = 1
+_NEXT_SLOT = 2
+_LAST_DECREASE = 3
+
+
+class AdaptiveLimiter(object):
+    """
+    Limit the number of requests in flight, and optionally the request rate,
+    adapting the concurrency limit with AIMD.
+
+    The limit grows by increase per limit's worth of good responses and is
+    multiplied by decrease_factor (at most once per target_latency) whenever
+    a request fails or takes longer than target_latency seconds. Grouper
+    counts a request as failed only when the host is at fault (see
+    transport.host_failed()), not for WS-level failures or for requests cut
+    short by the caller's own deadline.
+
+    With shared=True the state lives in shared memory, so one limiter can be
+    handed to child processes (as a Process argument or pool initarg) and
+    enforce a host-wide limit.
+    """
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=64, rate=None,
+                 target_latency=2.0, increase=1.0, decrease_factor=0.5,
+                 shared=False):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.rate = rate
+        self.target_latency = target_latency
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        state = [float(initial_limit), 0.0, 0.0, 0.0]
+        if shared:
+            self._state = multiprocessing.Array('d', state, lock=False)
+            self._cond = multiprocessing.Condition()
+        else:
+            self._state = state
+            self._cond = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self._state[_LIMIT])
+
+    @property
+    def in_flight(self):
+        return int(self._state[_IN_FLIGHT])
+
+    def acquire(self):
+        """
+        Block until a request may be sent.
+        """
+        with self._cond:
+            while self._state[_IN_FLIGHT] >= int(self._state[_LIMIT]):
+                self._cond.wait()
+            self._state[_IN_FLIGHT] += 1
+            delay = 0
+            if self.rate:
+                now = time.time()
+                slot = max(now, self._state[_NEXT_SLOT])
+                self._state[_NEXT_SLOT] = slot + 1.0 / self.rate
+                delay = slot - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def release(self, latency, failed=False):
+        """
+        Record the outcome of a request started with acquire().
+        """
+        with self._cond:
+            self._state[_IN_FLIGHT] -= 1
+            limit = self._state[_LIMIT]
+            now = time.time()
+            if failed or latency > self.target_latency:
+                if now - self._state[_LAST_DECREASE] > self.target_latency:
+                    self._state[_LAST_DECREASE] = now
+                    limit = max(self.min_limit, limit * self.decrease_factor)
+                    logger.debug("Concurrency limit decreased to {0:.1f}".format(limit))
+            else:
+                limit = min(self.max_limit, limit + self.increase / limit)
+            self._state[_LIMIT] = limit
+            self._cond.notify_all()
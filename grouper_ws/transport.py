@@ -0,0 +1,438 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+try: # Py3
+    from urllib.parse import urlsplit, urlunsplit
+except ImportError: # Py2
+    from urlparse import urlsplit, urlunsplit
+
+import requests
+from requests.auth import HTTPBasicAuth
+from requests.utils import DEFAULT_CA_BUNDLE_PATH
+import urllib3
+
+from .deadlines import remaining, request_timeout
+
+
+# Exceptions from sending a request which mean the host could not be used
+CONNECTION_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    urllib3.exceptions.ProtocolError,
+    urllib3.exceptions.TimeoutError,
+)
+
+# Statuses sent by a proxy or container rather than by Grouper WS itself
+UNAVAILABLE_STATUSES = set([502, 503, 504])
+
+logger = logging.getLogger(__name__)
+
+
+def host_failed(response):
+    """
+    Return True if response shows that the host, rather than the request,
+    is at fault: a 502, 503 or 504, or any other 5xx without a WS result
+    body. Grouper WS also answers 500 for application-level failures such
+    as PROBLEM_WITH_ASSIGNMENT, which say nothing about the host's health.
+    """
+    if response.status_code < 500:
+        return False
+    if response.status_code in UNAVAILABLE_STATUSES:
+        return True
+    try:
+        body = json.loads(response.content.decode('utf-8'))
+    except ValueError:
+        return True
+    if not isinstance(body, dict):
+        return True
+    return not any(
+        isinstance(results, dict) and 'resultMetadata' in results
+        for results in body.values()
+    )
+
+
+class RequestsTransport(object):
+    """
+    Send requests through a requests.Session. This is the default transport.
+    """
+    def __init__(self, session):
+        self.session = session
+
+    def send(self, method, url, headers, body, auth=None, retryable=False, timeout=None):
+        return getattr(self.session, method)(
+            url, headers=headers, data=body, auth=auth, timeout=timeout
+        )
+
+
+class ReplayResponse(object):
+    """
+    Minimal stand-in for requests.Response served from a recording.
+    """
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+        self.raw = None
+
+    def __repr__(self):
+        return '<ReplayResponse [{0}]>'.format(self.status_code)
+
+
+def request_key(method, url, headers, body):
+    """
+    Return a canonical key for a request: the method, the URL path and the
+    JSON body with sorted keys. The host is left out so that recordings can
+    be replayed against any client configuration.
+    """
+    if body and headers.get('Content-Encoding') == 'gzip':
+        body = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    try:
+        body = json.dumps(json.loads(body), sort_keys=True, separators=(',', ':'))
+    except ValueError:
+        pass
+    path = urlsplit(url).path
+    digest = hashlib.sha1()
+    for part in (method.lower(), path, body or ''):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class RecordingTransport(object):
+    """
+    Pass requests on to another transport and append every request/response
+    pair to a gzipped NDJSON archive at path.
+    """
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, 'ab')
+
+    def send(self, method, url, headers, body, auth=None, retryable=False, timeout=None):
+        started = time.time()
+        response = self.transport.send(
+            method, url, headers, body, auth=auth, retryable=retryable, timeout=timeout
+        )
+        latency = time.time() - started
+        record = {
+            'key': request_key(method, url, headers, body),
+            'method': method,
+            'url': url,
+            'status': response.status_code,
+            'content_type': response.headers.get('Content-Type'),
+            'content': response.content.decode('utf-8'),
+            'latency': latency,
+        }
+        line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+        with self._lock:
+            self._file.write(line)
+        return response
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class ReplayTransport(object):
+    """
+    Serve responses from an archive written by RecordingTransport.
+
+    Requests are matched by request_key(). When a request was recorded more
+    than once the responses are served in recorded order, repeating the last
+    one. With recorded_latency, each reply is delayed by the latency seen
+    when it was recorded; otherwise replies are immediate.
+    """
+    def __init__(self, path, recorded_latency=False):
+        self.recorded_latency = recorded_latency
+        self._lock = threading.Lock()
+        self._records = {}
+        with gzip.open(path, 'rb') as f:
+            for line in f:
+                record = json.loads(line.decode('utf-8'))
+                self._records.setdefault(record['key'], []).append(record)
+
+    def send(self, method, url, headers, body, auth=None, retryable=False, timeout=None):
+        key = request_key(method, url, headers, body)
+        with self._lock:
+            records = self._records.get(key)
+            if not records:
+                raise Exception("ReplayTransport: No recorded response for {0} {1}".format(
+                    method.upper(), url
+                ))
+            record = records.pop(0) if len(records) > 1 else records[0]
+        if self.recorded_latency:
+            time.sleep(record['latency'])
+        headers = {}
+        if record.get('content_type'):
+            headers['Content-Type'] = record['content_type']
+        return ReplayResponse(record['status'], record['content'].encode('utf-8'), headers)
+
+
+class _Node(object):
+    def __init__(self, host):
+        self.host = host
+        self.outstanding = 0
+        self.latency = None
+        self.failures = 0
+        self.ejected_until = None
+        self.checking = False
+
+
+class ClusterTransport(object):
+    """
+    Spread requests across several Grouper WS hosts.
+
+    Each request goes to the healthy node with the fewest outstanding
+    requests ('least_outstanding') or the lowest latency-weighted load
+    ('latency'). A node failing max_failures times in a row (a connection
+    error, a timeout, or a response for which host_failed() is true) is
+    ejected for eject_seconds, then re-admitted once a GET of health_path
+    succeeds. Health checks run in the background with their own
+    health_timeout, so they never hold up a request. Retryable (read)
+    requests which fail in those ways are tried again on the other nodes,
+    each attempt bounded by the time left before any deadlines.deadline().
+    """
+    STRATEGIES = ['least_outstanding', 'latency']
+
+    def __init__(self, hosts, transport, strategy='least_outstanding',
+                 max_failures=3, eject_seconds=30,
+                 health_path='status?diagnosticType=trivial', health_timeout=5):
+        if strategy not in ClusterTransport.STRATEGIES:
+            raise Exception("strategy must be in '{0}'".format(ClusterTransport.STRATEGIES))
+        if not hosts:
+            raise Exception("ClusterTransport(): No hosts specified!")
+        self.nodes = [_Node(host) for host in hosts]
+        self.transport = transport
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.health_path = health_path
+        self.health_timeout = health_timeout
+        self._lock = threading.Lock()
+        self._health_executor = ThreadPoolExecutor(max_workers=len(self.nodes))
+
+    def _load(self, node):
+        if self.strategy == 'latency':
+            return (node.outstanding + 1) * (node.latency or 0.0)
+        return (node.outstanding, node.latency or 0.0)
+
+    def _choose(self, exclude):
+        with self._lock:
+            candidates = [
+                node for node in self.nodes
+                if node not in exclude and node.ejected_until is None
+            ]
+            if not candidates:
+                # Everything is ejected: try the node due back soonest
+                candidates = sorted(
+                    (node for node in self.nodes if node not in exclude),
+                    key=lambda node: node.ejected_until
+                )[:1]
+            node = min(candidates, key=self._load)
+            node.outstanding += 1
+            return node
+
+    def _finished(self, node, latency, failed):
+        with self._lock:
+            node.outstanding -= 1
+            if failed:
+                node.failures += 1
+                if node.failures >= self.max_failures and node.ejected_until is None:
+                    node.ejected_until = time.time() + self.eject_seconds
+                    logger.warning("Ejecting Grouper node {0}".format(node.host))
+            else:
+                node.failures = 0
+                node.ejected_until = None
+                if node.latency is None:
+                    node.latency = latency
+                else:
+                    node.latency = 0.8 * node.latency + 0.2 * latency
+
+    def _check_ejected(self, url, auth):
+        """
+        Start background health checks of ejected nodes which are due.
+        """
+        now = time.time()
+        due = []
+        with self._lock:
+            for node in self.nodes:
+                if node.ejected_until is not None and node.ejected_until <= now \
+                        and not node.checking:
+                    node.checking = True
+                    due.append(node)
+        for node in due:
+            self._health_executor.submit(self._health_check, node, url, auth)
+
+    def _health_check(self, node, url, auth):
+        """
+        Re-admit node if it answers a health check, otherwise keep it ejected.
+        """
+        healthy = False
+        try:
+            health_url = self._node_url(node, url, self.health_path)
+            healthy = self.transport.send(
+                'get', health_url, {}, None, auth=auth, timeout=self.health_timeout
+            ).status_code < 500
+        except Exception as e:
+            logger.debug("Health check of {0} failed: {1}".format(node.host, e))
+        with self._lock:
+            node.checking = False
+            if healthy:
+                node.failures = 0
+                node.ejected_until = None
+                logger.info("Re-admitting Grouper node {0}".format(node.host))
+            else:
+                node.ejected_until = time.time() + self.eject_seconds
+
+    def _node_url(self, node, url, path=None):
+        parts = urlsplit(url)
+        if path is None:
+            return urlunsplit((parts.scheme, node.host, parts.path, parts.query, parts.fragment))
+        # Health checks live beside servicesRest, under the WS base path
+        base = parts.path.split('servicesRest')[0]
+        return urlunsplit((parts.scheme, node.host, base + path, '', ''))
+
+    def send(self, method, url, headers, body, auth=None, retryable=False, timeout=None):
+        self._check_ejected(url, auth)
+        tried = []
+        while True:
+            # Each attempt only gets the time left before the deadline
+            attempt_timeout = request_timeout(timeout)
+            node = self._choose(tried)
+            tried.append(node)
+            started = time.time()
+            response = None
+            error = None
+            try:
+                response = self.transport.send(
+                    method, self._node_url(node, url), headers, body,
+                    auth=auth, timeout=attempt_timeout
+                )
+            except CONNECTION_ERRORS as e:
+                error = e
+            except Exception:
+                self._finished(node, time.time() - started, False)
+                raise
+            failed = error is not None or host_failed(response)
+            self._finished(node, time.time() - started, failed)
+            left = remaining()
+            if not failed or not retryable or len(tried) == len(self.nodes) or \
+                    (left is not None and left <= 0):
+                if error is not None:
+                    raise error
+                return response
+            logger.warning("Request to {0} failed, failing over".format(node.host))
+
+
+class PooledResponse(object):
+    """
+    Minimal stand-in for requests.Response wrapping a urllib3 response.
+    """
+    def __init__(self, raw):
+        self.raw = raw
+        self.status_code = raw.status
+        self.headers = raw.headers
+        self.content = raw.data
+
+    def __repr__(self):
+        return '<PooledResponse [{0}]>'.format(self.status_code)
+
+
+def _ca_bundle(verify):
+    if verify is not True:
+        return verify
+    # The same lookup as requests with trust_env
+    return os.environ.get('REQUESTS_CA_BUNDLE') or \
+        os.environ.get('CURL_CA_BUNDLE') or DEFAULT_CA_BUNDLE_PATH
+
+
+class Urllib3Transport(object):
+    """
+    Send requests straight through a urllib3 PoolManager, skipping the hook
+    dispatch, header merging and response wrapping of requests.Session.
+
+    Certificates are verified as requests does: against $REQUESTS_CA_BUNDLE,
+    $CURL_CA_BUNDLE or the certifi bundle when verify is True, against the
+    given file or directory when it is a path, and not at all when it is
+    False. cert is a client certificate path or (certificate, key) tuple.
+
+    Basic auth, given as a (username, password) tuple or
+    requests.auth.HTTPBasicAuth, is sent as a precomputed header. Other
+    authentication handlers, such as Negotiate, depend on the requests
+    response hooks, so those requests are passed to fallback (usually a
+    RequestsTransport) instead, with a warning, so pass basic auth to make
+    use of this transport. Proxies and redirects are not followed.
+    """
+    def __init__(self, verify=True, cert=None, num_pools=10, maxsize=10, fallback=None):
+        kwargs = {}
+        if verify is False:
+            kwargs['cert_reqs'] = 'CERT_NONE'
+        else:
+            kwargs['cert_reqs'] = 'CERT_REQUIRED'
+            bundle = _ca_bundle(verify)
+            if os.path.isdir(bundle):
+                kwargs['ca_cert_dir'] = bundle
+            else:
+                kwargs['ca_certs'] = bundle
+        if isinstance(cert, tuple):
+            kwargs['cert_file'], kwargs['key_file'] = cert
+        elif cert is not None:
+            kwargs['cert_file'] = cert
+        self.pool = urllib3.PoolManager(num_pools=num_pools, maxsize=maxsize, **kwargs)
+        self.fallback = fallback
+        self._auth_headers = {}
+        self._warned = False
+
+    def _auth_header(self, auth):
+        if isinstance(auth, HTTPBasicAuth):
+            auth = (auth.username, auth.password)
+        if not isinstance(auth, tuple):
+            return None
+        header = self._auth_headers.get(auth)
+        if header is None:
+            header = self._auth_headers[auth] = urllib3.util.make_headers(
+                basic_auth='{0}:{1}'.format(*auth)
+            )['authorization']
+        return header
+
+    def send(self, method, url, headers, body, auth=None, retryable=False, timeout=None):
+        request_headers = dict(headers)
+        if auth is not None:
+            header = self._auth_header(auth)
+            if header is None:
+                if self.fallback is None:
+                    raise Exception("Urllib3Transport: Unsupported auth handler {0!r}".format(auth))
+                if not self._warned:
+                    self._warned = True
+                    logger.warning(
+                        "Urllib3Transport: Sending requests with {0} auth through the fallback "
+                        "transport".format(type(auth).__name__)
+                    )
+                return self.fallback.send(
+                    method, url, headers, body, auth=auth, retryable=retryable, timeout=timeout
+                )
+            request_headers['Authorization'] = header
+        request_headers.setdefault('Accept-Encoding', 'gzip, deflate')
+        if isinstance(timeout, tuple):
+            timeout = urllib3.Timeout(connect=timeout[0], read=timeout[1])
+        elif timeout is None:
+            timeout = urllib3.Timeout(connect=None, read=None)
+        raw = self.pool.request(
+            method.upper(), url, body=body, headers=request_headers,
+            timeout=timeout, retries=False
+        )
+        return PooledResponse(raw)
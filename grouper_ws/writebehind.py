@@ -0,0 +1,219 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from collections import OrderedDict
+from concurrent.futures import Future
+import logging
+import threading
+import time
+
+from .api import member_to_subject_lookup, str_to_group
+from .bulk import add_members_checked, chunked, delete_members_checked, \
+    run_concurrently, DEFAULT_CHUNK_SIZE, DEFAULT_MAX_WORKERS
+
+
+logger = logging.getLogger(__name__)
+
+
+def _member_key(member):
+    return tuple(sorted(member_to_subject_lookup(member).items()))
+
+
+def _resolve(future, outcome):
+    # Futures cancelled by the caller, or already resolved, are left alone
+    if future.done() or not future.set_running_or_notify_cancel():
+        return
+    if isinstance(outcome, Exception):
+        future.set_exception(outcome)
+    else:
+        future.set_result(outcome)
+
+
+def _fail(due, error):
+    for mutations in due.values():
+        for entry in mutations.values():
+            for future in entry[2]:
+                _resolve(future, error)
+
+
+class MembershipWriteBuffer(object):
+    """
+    Collect add/delete membership mutations per group and apply them in
+    chunked add_members/delete_members calls.
+
+    A group's mutations are sent once the oldest has waited window seconds,
+    once max_size subjects are pending for it, or on flush()/close(). Within
+    a window only the latest mutation of each subject is sent, so an add
+    followed by a delete of the same subject is sent as just the delete.
+    Each mutation returns a Future which receives its results.ItemResult,
+    or an exception if the subject could not be added or deleted.
+
+    If the background thread stops on an unexpected error, every pending
+    Future fails with it and later mutations and flushes raise.
+    """
+    def __init__(self, grouper, window=1.0, max_size=1000,
+                 chunk_size=DEFAULT_CHUNK_SIZE, max_workers=DEFAULT_MAX_WORKERS):
+        self.grouper = grouper
+        self.window = window
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._oldest = {}
+        self._flush_requested = 0
+        self._flushed = 0
+        self._closed = False
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='MembershipWriteBuffer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, group, member):
+        return self._enqueue(group, 'add', member)
+
+    def delete(self, group, member):
+        return self._enqueue(group, 'delete', member)
+
+    def _enqueue(self, group, op, member):
+        group = str_to_group(group).group_name
+        key = _member_key(member)
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise Exception("MembershipWriteBuffer is closed")
+            self._check_alive()
+            mutations = self._pending.setdefault(group, OrderedDict())
+            if not mutations:
+                self._oldest[group] = time.time()
+                # Wake the flusher so it schedules this group's deadline
+                self._cond.notify_all()
+            entry = mutations.get(key)
+            if entry is None:
+                mutations[key] = [op, member, [future]]
+            else:
+                # Latest mutation wins; earlier futures share its outcome
+                entry[0] = op
+                entry[1] = member
+                entry[2].append(future)
+            if len(mutations) >= self.max_size:
+                self._cond.notify_all()
+        return future
+
+    def flush(self):
+        """
+        Send every pending mutation and wait for the requests to finish.
+        """
+        with self._cond:
+            self._flush_requested += 1
+            target = self._flush_requested
+            self._cond.notify_all()
+            while self._flushed < target and self._error is None and self._thread.is_alive():
+                self._cond.wait()
+            if self._flushed < target:
+                self._check_alive()
+                raise Exception("MembershipWriteBuffer is closed")
+
+    def _check_alive(self):
+        if self._error is not None:
+            raise Exception("MembershipWriteBuffer stopped: {0}".format(self._error))
+
+    def close(self):
+        """
+        Flush pending mutations and stop the background thread.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _take_due(self):
+        """
+        Remove and return the mutations which should be sent now, with the
+        number of seconds until the next group falls due. Called with the
+        condition held.
+        """
+        now = time.time()
+        take_all = self._closed or self._flush_requested > self._flushed
+        due = {}
+        next_due = None
+        for group in list(self._pending):
+            mutations = self._pending[group]
+            deadline = self._oldest[group] + self.window
+            if take_all or deadline <= now or len(mutations) >= self.max_size:
+                due[group] = self._pending.pop(group)
+                del self._oldest[group]
+            elif next_due is None or deadline - now < next_due:
+                next_due = deadline - now
+        return due, next_due
+
+    def _run(self):
+        try:
+            self._loop()
+        except Exception as e:
+            logger.exception("Write-behind thread stopped")
+            with self._cond:
+                self._error = e
+                due = self._pending
+                self._pending = {}
+                self._oldest = {}
+                self._cond.notify_all()
+            _fail(due, e)
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                flush_target = self._flush_requested
+                due, next_due = self._take_due()
+                if not due:
+                    self._flushed = flush_target
+                    self._cond.notify_all()
+                    if self._closed:
+                        return
+                    self._cond.wait(next_due)
+                    continue
+            try:
+                self._apply(due)
+            except Exception as e:
+                logger.exception("Write-behind batch failed")
+                _fail(due, e)
+            with self._cond:
+                if not self._pending:
+                    self._flushed = flush_target
+                    self._cond.notify_all()
+
+    def _apply(self, due):
+        batches = []
+        for group, mutations in due.items():
+            for op in ('add', 'delete'):
+                entries = [entry for entry in mutations.values() if entry[0] == op]
+                for chunk in chunked(entries, self.chunk_size):
+                    batches.append((group, op, chunk))
+
+        def send(batch):
+            group, op, entries = batch
+            members = [entry[1] for entry in entries]
+            if op == 'add':
+                return add_members_checked(self.grouper, group, members)
+            return delete_members_checked(self.grouper, group, members)
+
+        for (group, op, entries), result, error in run_concurrently(send, batches, self.max_workers):
+            if error is not None:
+                logger.warning("Write-behind {0} for {1} failed: {2}".format(op, group, error))
+                outcomes = [error] * len(entries)
+            else:
+                outcomes = result.items
+            for entry, outcome in zip(entries, outcomes):
+                if not isinstance(outcome, Exception) and not outcome.success:
+                    outcome = Exception("{0} of {1} in {2} failed: {3}".format(
+                        op, entry[1], group, outcome.result_code
+                    ))
+                for future in entry[2]:
+                    _resolve(future, outcome)
@@ -31,5 +31,10 @@ setup(
     packages=['grouper_ws'],
     package_dir={'grouper_ws': 'grouper_ws'},
     install_requires=install_requires,
+    entry_points={
+        'console_scripts': [
+            'grouper-ws = grouper_ws.cli:main',
+        ],
+    },
     dependency_links=dependency_links,
 )